@@ -0,0 +1,895 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+
+def normalizeHistogram(hist):
+    """ Return histograms (last axis) normalized to unit sum. """
+    hist = np.asarray(hist, dtype=np.float64)
+    total = hist.sum(axis=-1, keepdims=True)
+    return hist / np.where(total > 0, total, 1)
+
+
+def jensenShannon(p, q):
+    """ Jensen-Shannon divergence (base 2, in [0, 1]) between
+    histograms along the last axis. Inputs are broadcast. """
+    p = normalizeHistogram(p)
+    q = normalizeHistogram(q)
+    m = (p + q) / 2
+
+    def _kl(a, b):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(a > 0, a * np.log2(a / b), 0.0)
+        return terms.sum(axis=-1)
+
+    return np.clip((_kl(p, m) + _kl(q, m)) / 2, 0, 1)
+
+
+def _sinkhornCost(p, q, kernel, cost, iters):
+    """ Entropic transport cost between the columns of p and q. """
+    u = np.ones_like(p)
+    v = np.ones_like(q)
+    for _ in range(iters):
+        u = p / np.maximum(kernel.dot(v), 1e-300)
+        v = q / np.maximum(kernel.T.dot(u), 1e-300)
+    return np.einsum('ib,ij,jb->b', u, kernel * cost, v)
+
+
+def sphereEMD(p, q, grid, reg=None, iters=200):
+    """ Earth mover's distance (degrees) on the sphere between histograms
+    p and q defined on the cells of grid.
+
+    The transport problem is solved for all histogram pairs at once with
+    Sinkhorn iterations; the entropic bias is removed by subtracting the
+    self-transport terms (Sinkhorn divergence).
+    p and q can be 1D (one histogram) or 2D (one histogram per row).
+    """
+    p = np.atleast_2d(normalizeHistogram(p))
+    q = np.atleast_2d(normalizeHistogram(q))
+    p, q = np.broadcast_arrays(p, q)
+    cost = grid.angularDistances()
+    reg = reg or grid.angSampling
+    kernel = np.exp(-cost / reg)
+    cols = np.concatenate([p, p, q], axis=0).T
+    rows = np.concatenate([q, p, q], axis=0).T
+    w = _sinkhornCost(cols, rows, kernel, cost, iters)
+    n = p.shape[0]
+    emd = w[:n] - (w[n:2 * n] + w[2 * n:]) / 2
+    return np.maximum(emd, 0)
+
+
+def coverageMask(hist, minDensity=0.1):
+    """ Return a boolean mask of the cells whose density is at least
+    minDensity times the density of a uniform distribution. """
+    p = normalizeHistogram(hist)
+    return p * p.shape[-1] >= minDensity
+
+
+def coverageGap(ref, other, minDensity=0.1):
+    """ Coverage difference map between two histograms:
+    -1 where only ref covers the cell (gap), +1 where only other does
+    (gain) and 0 elsewhere. """
+    refMask = coverageMask(ref, minDensity)
+    otherMask = coverageMask(other, minDensity)
+    return otherMask.astype(np.int8) - refMask.astype(np.int8)
+
+
+def inverseDensityWeights(cells, hist, counts):
+    """ Weight of each particle inversely proportional to the density
+    (hist) of its grid cell. counts is the number of particles of every
+    cell, used to normalize the weights of the whole set to a mean of one,
+    so cells can be given one chunk of particles at a time. """
+    occupied = counts > 0
+    scale = counts.sum() / (counts[occupied] / hist[occupied]).sum()
+    return scale / hist[cells]
+
+
+def hashIds(ids):
+    """ Deterministic pseudo-random 32 bit key of each item id
+    (Knuth multiplicative hash, a bijection of 32 bit ids). """
+    ids = np.asarray(ids).astype(np.uint64)
+    return (ids * np.uint64(2654435761)) % np.uint64(2 ** 32)
+
+
+def flattenThresholds(chunks, nCells, maxPerCell):
+    """ Per cell key threshold that keeps at most maxPerCell items in each
+    grid cell: items with hashIds(id) <= threshold[cell] are kept.
+
+    chunks is a callable returning an iterator of (keys, cells) arrays; it
+    is called once to count the items and then once for each byte of the
+    keys, which selects the maxPerCell-th smallest key of every cell
+    (radix selection) without holding all the items in memory.
+    """
+    counts = np.zeros(nCells, dtype=np.int64)
+    for keys, cells in chunks():
+        counts += np.bincount(cells, minlength=nCells)
+    # rank (1-based) of the last key kept in each cell
+    rank = np.minimum(counts, maxPerCell)
+    prefix = np.zeros(nCells, dtype=np.uint64)
+    below = np.zeros(nCells, dtype=np.int64)
+
+    for shift in (24, 16, 8, 0):
+        hist = np.zeros(nCells * 256, dtype=np.int64)
+        high = np.uint64(shift + 8)
+        for keys, cells in chunks():
+            match = (keys >> high) == (prefix[cells] >> high)
+            byte = (keys[match] >> np.uint64(shift)) & np.uint64(255)
+            hist += np.bincount(cells[match] * 256 + byte.astype(np.int64),
+                                minlength=nCells * 256)
+        cum = below[:, None] + np.cumsum(hist.reshape(nCells, 256), axis=1)
+        selected = np.argmax(cum >= rank[:, None], axis=1)
+        rows = np.arange(nCells)
+        below = np.where(selected > 0, cum[rows, selected - 1], below)
+        prefix |= selected.astype(np.uint64) << np.uint64(shift)
+
+    return np.where(counts > maxPerCell, prefix, np.uint64(2 ** 32))
+
+
+# Sampling (deg) of the angle between a Fourier direction and the
+# central sections, used to accumulate the geometric sums
+THETA_STEP = 0.5
+THETA_BINS = int(round(90 / THETA_STEP))
+# Maximum number of direction/bin pairs evaluated at once
+CHUNK_PAIRS = 4000000
+
+
+def getSymmetryMatrices(symmetryGroup='c1'):
+    """ Return the rotation matrices (n x 3 x 3) of a symmetry group given
+    in cryoEF/RELION notation (c1, c4, d7, t, o, i1...). """
+    sym = (symmetryGroup or 'c1').strip().lower()
+    if sym in ('c1', ''):
+        return np.eye(3)[None]
+
+    import pwem.constants as cts
+    from pwem.convert.symmetry import getSymmetryMatrices as _getMatrices
+
+    symDict = {'c': cts.SYM_CYCLIC, 'd': cts.SYM_DIHEDRAL_X,
+               't': cts.SYM_TETRAHEDRAL_Z3, 'o': cts.SYM_OCTAHEDRAL,
+               'i': cts.SYM_I222, 'i1': cts.SYM_I222, 'i2': cts.SYM_I222r,
+               'i3': cts.SYM_In25, 'i4': cts.SYM_In25r}
+    if sym[0] in 'cd':
+        symType, order = symDict[sym[0]], int(sym[1:])
+    elif sym in symDict:
+        symType, order = symDict[sym], 1
+    else:
+        raise ValueError('Unsupported symmetry group: %s' % symmetryGroup)
+
+    matrices = np.asarray(_getMatrices(sym=symType, n=order))
+    return matrices[:, :3, :3]
+
+
+def angleHistogram(angles, grid, symmetryGroup='c1', chunkSize=None):
+    """ Orientation histogram of an AngleSet, converting at most chunkSize
+    angles to directions at a time (e.g. for memory-mapped sets). """
+    hist = np.zeros(grid.size)
+    for chunk in angles.iterChunks(chunkSize):
+        hist += grid.histogram(chunk.to_vectors())
+    return expandHistogram(hist, grid, symmetryGroup)
+
+
+def orientationHistogram(vectors, grid, symmetryGroup='c1', weights=None):
+    """ Histogram of projection directions on a hemisphere grid, expanded
+    by the symmetry of the molecule.
+
+    The expansion is applied to the occupied cells rather than to each
+    particle, so its cost does not depend on the number of particles.
+    """
+    hist = grid.histogram(vectors, weights)
+    return expandHistogram(hist, grid, symmetryGroup)
+
+
+def expandHistogram(hist, grid, symmetryGroup='c1'):
+    """ Apply the symmetry operators to grid histograms (last axis). """
+    matrices = getSymmetryMatrices(symmetryGroup)
+    if len(matrices) == 1:
+        return hist
+    expanded = np.zeros_like(hist)
+    for matrix in matrices:
+        target = grid.getIndex(grid.directions.dot(matrix.T))
+        np.add.at(expanded, (Ellipsis, target), hist)
+    return expanded
+
+
+class GroupHistograms:
+    """ Histograms of grid cell indexes per group label, accumulated one
+    chunk of particles at a time.
+
+    Only the counts of the (group, cell) pairs present are kept, so the
+    memory use depends on the number of occupied pairs and not on the
+    number of particles.
+    """
+    # Number of chunks kept before merging their pair counts
+    MERGE_CHUNKS = 16
+
+    def __init__(self, nCells):
+        self.nCells = nCells
+        self._keys = []
+        self._counts = []
+
+    def add(self, groups, cells):
+        """ Add the group label and the grid cell of a chunk of
+        particles. """
+        keys, counts = np.unique(np.asarray(groups, dtype=np.int64) *
+                                 self.nCells + cells, return_counts=True)
+        self._keys.append(keys)
+        self._counts.append(counts)
+        if len(self._keys) >= self.MERGE_CHUNKS:
+            self._merge()
+
+    def _merge(self):
+        keys, inverse = np.unique(np.concatenate(self._keys),
+                                  return_inverse=True)
+        counts = np.bincount(inverse.ravel(),
+                             weights=np.concatenate(self._counts))
+        self._keys, self._counts = [keys], [counts]
+
+    def labels(self):
+        """ Sorted unique labels added so far, and their number of
+        particles. """
+        if not self._keys:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        self._merge()
+        labels, inverse = np.unique(self._keys[0] // self.nCells,
+                                    return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=self._counts[0],
+                             minlength=len(labels))
+        return labels, counts.astype(np.int64)
+
+    def histograms(self, blocks=None):
+        """ Returns the sorted unique labels and their histograms
+        (nGroups x nCells). If blocks is given (the block index of each
+        of the sorted unique labels), the histograms of the labels of each
+        block are summed and the block histograms (nBlocks x nCells) are
+        returned instead, without building those of every label. """
+        if not self._keys:
+            empty = np.zeros((0, self.nCells))
+            return empty if blocks is not None else (
+                np.array([], dtype=np.int64), empty)
+        self._merge()
+        keys, counts = self._keys[0], self._counts[0]
+        labels, inverse = np.unique(keys // self.nCells, return_inverse=True)
+        if blocks is not None:
+            rows = np.asarray(blocks)[inverse.ravel()]
+            nBlocks = int(rows.max()) + 1
+            hists = np.bincount(rows * self.nCells + keys % self.nCells,
+                                weights=counts,
+                                minlength=nBlocks * self.nCells)
+            return hists.reshape(nBlocks, self.nCells)
+        hists = np.zeros((len(labels), self.nCells))
+        hists[inverse.ravel(), keys % self.nCells] = counts
+        return labels, hists
+
+
+def _thetaBins(sinTheta):
+    """ Theta bin of the angle between directions and central sections,
+    given the absolute value of their cosine (sine of the angle). """
+    return np.minimum(np.degrees(np.arcsin(np.minimum(sinTheta, 1))) /
+                      THETA_STEP, THETA_BINS - 1).astype(np.int64)
+
+
+def geometricSums(hist, grid, directions, chunkPairs=CHUNK_PAIRS):
+    """ Accumulate, for each Fourier-space direction, the histogram weights
+    as a function of the angle between that direction and the central
+    section of every occupied cell.
+
+    Returns a (nDirections x THETA_BINS) array. Everything else in the PSF
+    model (diameter, accuracy, B-factor, resolution) is applied on top of
+    these sums, so they only need to be computed once per distribution.
+    At most chunkPairs direction/cell pairs are evaluated at once.
+    """
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    cells = np.flatnonzero(hist)
+    centers = grid.directions[cells]
+    weights = hist[cells]
+    sums = np.zeros((len(directions), THETA_BINS))
+    chunk = max(1, chunkPairs // max(1, len(cells)))
+
+    for start in range(0, len(directions), chunk):
+        block = directions[start:start + chunk]
+        index = _thetaBins(np.abs(block.dot(centers.T)))
+        index += np.arange(len(block))[:, None] * THETA_BINS
+        sums[start:start + len(block)] = np.bincount(
+            index.ravel(), weights=np.broadcast_to(weights, index.shape).ravel(),
+            minlength=len(block) * THETA_BINS).reshape(len(block), THETA_BINS)
+
+    return sums
+
+
+class OrientationAccumulator:
+    """ Geometric sums of a growing orientation distribution.
+
+    The sums are linear in the histogram weights, so adding a block of
+    particles only needs the sums of that block, and the PSF model can be
+    evaluated at any point without revisiting the previous particles.
+    """
+    def __init__(self, histGrid, directions, symmetryGroup='c1'):
+        self.histGrid = histGrid
+        self.directions = np.asarray(directions, dtype=np.float64)
+        self.symmetryGroup = symmetryGroup
+        self.hist = np.zeros(histGrid.size)
+        self.sums = np.zeros((len(self.directions), THETA_BINS))
+        self.count = 0
+
+    def add(self, vectors, weights=None):
+        """ Add the projection directions of a block of particles. """
+        self.addHistogram(self.histGrid.histogram(vectors, weights),
+                          len(vectors))
+
+    def addHistogram(self, hist, count=None):
+        """ Add the histogram of grid cells (before symmetry expansion) of
+        a block of particles. """
+        block = expandHistogram(hist, self.histGrid, self.symmetryGroup)
+        self.hist += block
+        self.sums += geometricSums(block, self.histGrid, self.directions)
+        self.count += int(hist.sum()) if count is None else count
+
+
+class OrientationIndex:
+    """ Scores of any subset of a particle set, from the orientation cell
+    of every particle.
+
+    ids (sorted) and cells can be memory-mapped arrays. The theta bin of
+    every pair of grid directions and cells occupied by the whole set is
+    tabulated once, so the geometric sums of a subset are a bincount of
+    the table weighted by the subset histogram, which does not depend on
+    the number of particles.
+    """
+    def __init__(self, ids, cells, grid, symmetryGroup='c1',
+                 chunkPairs=CHUNK_PAIRS):
+        self.ids = ids
+        self.cells = cells
+        self.grid = grid
+        self.symmetryGroup = symmetryGroup
+        self.chunkPairs = chunkPairs
+        hist = expandHistogram(np.bincount(cells, minlength=grid.size),
+                               grid, symmetryGroup)
+        self.occupied = np.flatnonzero(hist)
+        self._table = _thetaBins(np.abs(grid.directions.dot(
+            grid.directions[self.occupied].T))).astype(np.uint8)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, ids):
+        """ Positions in the index of the given particle ids, sorted and
+        without repetitions. Ids not in the index are ignored. """
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        pos = np.searchsorted(self.ids, ids)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == ids[found]
+        return pos[found]
+
+    def histogram(self, ids=None):
+        """ Orientation histogram of the particles with the given ids
+        (all of them if None), expanded by symmetry. """
+        cells = self.cells if ids is None else self.cells[self.select(ids)]
+        hist = np.bincount(cells, minlength=self.grid.size).astype(np.float64)
+        return expandHistogram(hist, self.grid, self.symmetryGroup)
+
+    def sums(self, hist):
+        """ Geometric sums (see geometricSums) of a histogram of the grid
+        along the grid directions. """
+        weights = hist[self.occupied]
+        sums = np.zeros((self.grid.size, THETA_BINS))
+        rows = max(1, self.chunkPairs // max(1, len(self.occupied)))
+        for start in range(0, self.grid.size, rows):
+            block = self._table[start:start + rows].astype(np.int64)
+            block += np.arange(len(block))[:, None] * THETA_BINS
+            sums[start:start + len(block)] = np.bincount(
+                block.ravel(),
+                weights=np.broadcast_to(weights, block.shape).ravel(),
+                minlength=len(block) * THETA_BINS).reshape(-1, THETA_BINS)
+        return sums
+
+    def score(self, model, ids=None):
+        """ Return the number of particles of a subset (given by ids) and
+        its PSF statistics: efficiency, mean, standard deviation, worst and
+        best resolution (NaN for an empty subset). """
+        hist = self.histogram(ids)
+        count = int(hist.sum()) // len(getSymmetryMatrices(
+            self.symmetryGroup))
+        if not count:
+            return 0, (np.nan,) * 5
+        return count, model.statistics(model.resolution(self.sums(hist)))
+
+
+def estimateResolution(bfactor, nParticles):
+    """ Resolution (A) expected from nParticles asymmetric units with a
+    given B-factor, following ln(N) = B / (2 d^2). """
+    return np.sqrt(bfactor / (2 * np.log(np.maximum(nParticles, 3))))
+
+
+class PSFModel:
+    """ Model of the point spread function of an orientation distribution.
+
+    Each particle fills a central section of Fourier space of thickness
+    set by the particle diameter, blurred by the angular accuracy. The
+    coverage of a Fourier voxel at frequency k along a direction is the
+    sum of Gaussian slab profiles over all sections, and its signal decays
+    as exp(-B k^2 / 2). The PSF resolution along a direction is the
+    frequency where this signal drops to the level that a uniform
+    distribution of the same particles reaches at the FSC resolution
+    (estimated from the B-factor when not given).
+    """
+    def __init__(self, bfactor=160, diameter=200, angAcc=1, fscRes=-1,
+                 nFreq=256):
+        self.bfactor = float(bfactor)
+        self.diameter = float(diameter)
+        self.angAcc = float(angAcc)
+        self.fscRes = float(fscRes)
+        self.nFreq = nFreq
+        theta = np.radians((np.arange(THETA_BINS) + 0.5) * THETA_STEP)
+        self._sinTheta = np.sin(theta)
+        edges = np.sin(np.radians(np.arange(THETA_BINS + 1) * THETA_STEP))
+        # Fraction of uniform directions in each theta bin
+        self._uniform = np.diff(edges)
+
+    def getResolution(self, nParticles):
+        """ Resolution (A) reached by a uniform distribution. """
+        if self.fscRes > 0:
+            return np.full(np.shape(nParticles), self.fscRes)
+        return estimateResolution(self.bfactor, nParticles)
+
+    def getFrequencies(self, nParticles):
+        """ Frequency sampling (1/A) used to search the PSF resolution. """
+        kmax = 2.0 / self.getResolution(nParticles)
+        return np.linspace(kmax / self.nFreq, kmax, self.nFreq)
+
+    def kernel(self, freqs):
+        """ Slab profile (THETA_BINS x nFreq) of a central section seen
+        at each theta bin and frequency. """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        width2 = (0.5 / self.diameter) ** 2 + \
+            (freqs * np.radians(self.angAcc)) ** 2
+        dist2 = (self._sinTheta[:, None] * freqs[None, :]) ** 2
+        return np.exp(-dist2 / (2 * width2[None, :]))
+
+    def coverage(self, sums, freqs):
+        """ Coverage of Fourier space (nDirections x nFreq). """
+        return np.asarray(sums).dot(self.kernel(freqs))
+
+    def uniformCoverage(self, freqs):
+        """ Coverage per particle of a uniform distribution at each
+        frequency, the same along every direction. """
+        return self._uniform.dot(self.kernel(freqs))
+
+    def resolution(self, sums):
+        """ PSF resolution (A) along each direction of the sums.
+
+        The sums can have any number of leading dimensions; the number of
+        particles of each row is its total weight.
+        """
+        sums = np.asarray(sums, dtype=np.float64)
+        nParticles = sums.sum(axis=-1)
+        freqs = self.getFrequencies(nParticles.max())
+        return self.resolutionFromCoverage(sums.dot(self.kernel(freqs)),
+                                           nParticles, freqs)
+
+    def resolutionFromCoverage(self, coverage, nParticles, freqs):
+        """ PSF resolution (A) from the coverage (..., nFreq) sampled at
+        freqs, for distributions of nParticles (broadcast to the leading
+        dimensions of coverage).
+
+        The signal is above the threshold where the coverage exceeds the
+        level reached by a uniform distribution at the FSC resolution
+        corrected by the B-factor decay, so the crossing is found by
+        comparison and logarithms are only taken at its two neighbours.
+        """
+        nParticles = np.asarray(nParticles, dtype=np.float64)
+        k0 = 1.0 / self.getResolution(nParticles)
+        ref = self.uniformCoverage(k0.ravel()).reshape(k0.shape)
+        level = (ref * nParticles)[..., None] * np.exp(
+            self.bfactor * (freqs ** 2 - k0[..., None] ** 2) / 2)
+        above = coverage > level
+        last = np.clip(above.sum(axis=-1) - 1, 0, self.nFreq - 2)[..., None]
+        level = np.broadcast_to(level, coverage.shape)
+
+        def _signal(index):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.log(np.take_along_axis(coverage, index, -1) /
+                              np.take_along_axis(level, index, -1))[..., 0]
+
+        s0, s1 = _signal(last), _signal(last + 1)
+        last = last[..., 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(np.nan_to_num(s0 / (s0 - s1)), 0, 1)
+        freq = freqs[last] + t * (freqs[last + 1] - freqs[last])
+        freq = np.where(above[..., 0], freq, freqs[0])
+        freq = np.where(above[..., -1], freqs[-1], freq)
+        return 1.0 / freq
+
+    @staticmethod
+    def statistics(resolution, weights=None):
+        """ Return efficiency, mean, standard deviation, worst and best of
+        the PSF resolution (along the last axis). The efficiency is the
+        ratio between the harmonic and the arithmetic mean of the PSF
+        frequency extent. """
+        resolution = np.asarray(resolution, dtype=np.float64)
+        weights = np.ones_like(resolution) if weights is None else \
+            np.broadcast_to(weights, resolution.shape)
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+        mean = (weights * resolution).sum(axis=-1)
+        efficiency = 1.0 / (mean * (weights / resolution).sum(axis=-1))
+        std = np.sqrt((weights * (resolution - mean[..., None]) ** 2).sum(
+            axis=-1))
+        return (efficiency, mean, std, resolution.max(axis=-1),
+                resolution.min(axis=-1))
+
+
+def groupStatistics(model, hists, histGrid, grid):
+    """ PSF efficiency and mean resolution of many histograms of histGrid
+    (one per row), evaluated on the directions of grid.
+
+    The slab kernel of every (cell, direction) pair is tabulated once per
+    chunk of rows, so the coverage of all rows is a single matrix product,
+    and the rows are processed in chunks so the memory use does not
+    depend on the number of histograms. Empty rows get NaN.
+    """
+    hists = np.atleast_2d(hists)
+    index = _thetaBins(np.abs(histGrid.directions.dot(grid.directions.T)))
+    efficiency = np.full(len(hists), np.nan)
+    meanRes = np.full(len(hists), np.nan)
+    chunk = max(1, CHUNK_PAIRS // (grid.size * model.nFreq))
+
+    for start in range(0, len(hists), chunk):
+        block = hists[start:start + chunk]
+        nParticles = block.sum(axis=1)
+        rows = np.flatnonzero(nParticles > 0)
+        if not len(rows):
+            continue
+        freqs = model.getFrequencies(nParticles[rows].max())
+        cellKernel = model.kernel(freqs)[index].astype(np.float32)
+        # denormal values slow down the product and do not change the result
+        cellKernel[cellKernel < 1e-30] = 0
+        coverage = block[rows].astype(np.float32).dot(
+            cellKernel.reshape(histGrid.size, -1))
+        res = model.resolutionFromCoverage(
+            coverage.reshape(len(rows), grid.size, model.nFreq),
+            nParticles[rows, None], freqs)
+        eff, mean = model.statistics(res)[:2]
+        efficiency[start + rows] = eff
+        meanRes[start + rows] = mean
+
+    return efficiency, meanRes
+
+
+def histogramScores(labels, hists, grid, model, symmetryGroup='c1'):
+    """ Orientation scores of the groups of labels given their histograms
+    of grid cells (nGroups x grid.size), see GroupHistograms.
+
+    Returns the labels and, for each group, the number of particles, the
+    PSF efficiency, the mean PSF resolution and the fraction of grid
+    cells covered after symmetry expansion.
+    """
+    particles = hists.sum(axis=1).astype(np.int64)
+    hists = expandHistogram(hists, grid, symmetryGroup)
+    efficiency, meanRes = groupStatistics(model, hists, grid, grid)
+    coverage = np.count_nonzero(hists, axis=1) / grid.size
+    return labels, particles, efficiency, meanRes, coverage
+
+
+def directionResolution(model, hist, histGrid, directions,
+                        chunkPairs=CHUNK_PAIRS, sums=None):
+    """ PSF resolution along the given directions. The geometric sums and
+    the resolution are computed for blocks of directions so that at most
+    chunkPairs direction/cell pairs are held in memory. If sums is a list,
+    the sums of every block are appended to it (as float32). """
+    rows = max(1, chunkPairs // max(1, np.count_nonzero(hist)))
+    res = []
+    for start in range(0, len(directions), rows):
+        block = geometricSums(hist, histGrid, directions[start:start + rows],
+                              chunkPairs)
+        if sums is not None:
+            sums.append(block.astype(np.float32))
+        res.append(model.resolution(block))
+    return np.concatenate(res)
+
+
+def fixedResolution(model, hist, histGrid, sampling, chunkPairs=CHUNK_PAIRS,
+                    sums=None):
+    """ PSF resolution on a fixed hemisphere grid of the given sampling.
+    Returns the grid and the resolution of every cell. """
+    grid = type(histGrid)(sampling, hemisphere=True)
+    return grid, directionResolution(model, hist, histGrid, grid.directions,
+                                     chunkPairs, sums)
+
+
+# Number of evaluated directions each direction is interpolated from
+INTERP_NEIGHBOURS = 6
+
+
+def _interpolationWeights(points, queries, count=INTERP_NEIGHBOURS,
+                          leaveOut=False):
+    """ Weights to interpolate values known at the unit vectors points on
+    the unit vectors queries, considering antipodal directions as
+    equivalent. Each query gets a local linear fit, in its tangent plane,
+    of the count nearest points weighted by their inverse squared
+    distance, so linear variations are reproduced exactly. With leaveOut,
+    the queries are the points themselves and each one is fitted without
+    its own value (leave-one-out).
+
+    Returns the (nQueries x count) indexes of the points and weights.
+    """
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=np.float64)
+    queries = np.asarray(queries, dtype=np.float64)
+    both = np.concatenate([points, -points])
+    count = min(count, len(points) - int(leaveOut))
+    dist, index = cKDTree(both).query(queries, k=count + int(leaveOut))
+    dist, index = dist.reshape(len(queries), -1), index.reshape(
+        len(queries), -1)
+    if leaveOut:
+        dist, index = dist[:, 1:], index[:, 1:]
+
+    # tangent plane basis of every query
+    axis = np.where(np.abs(queries[:, :1]) < 0.9, [[1., 0, 0]], [[0, 1., 0]])
+    e1 = np.cross(queries, axis)
+    e1 /= np.linalg.norm(e1, axis=1, keepdims=True)
+    e2 = np.cross(queries, e1)
+    diff = both[index] - queries[:, None]
+    design = np.stack([np.ones(dist.shape), np.einsum('qkj,qj->qk', diff, e1),
+                       np.einsum('qkj,qj->qk', diff, e2)], axis=-1)
+    w = 1 / (dist ** 2 + 1e-12)
+    normal = np.einsum('qki,qk,qkj->qij', design, w, design)
+    # small ridge on the slopes for degenerate neighbourhoods
+    normal += 1e-9 * np.trace(normal, axis1=1, axis2=2)[:, None, None] * \
+        np.diag([0., 1., 1.])
+    rhs = np.broadcast_to([1., 0, 0], (len(queries), 3))[..., None]
+    coef = np.linalg.solve(normal, rhs)[..., 0]
+    weights = w * np.einsum('qki,qi->qk', design, coef)
+
+    exact = dist[:, 0] < 1e-9
+    weights[exact] = 0
+    weights[exact, 0] = 1
+    return index % len(points), weights
+
+
+def interpolate(values, rows, weights=None):
+    """ Resolution of the grid cells from the resolution of the evaluated
+    directions, given the rows (and interpolation weights) of every cell
+    (see adaptiveResolution). The logarithm of the resolution is
+    interpolated, as it varies much more smoothly than the resolution
+    across the edge of a missing cone. """
+    if rows is None:
+        return values
+    if weights is None:
+        return values[rows]
+    return np.exp((np.log(values[rows]) * weights).sum(axis=-1))
+
+
+def adaptiveResolution(model, hist, histGrid, sampling, tolerance,
+                       coarseSampling=8.0, chunkPairs=CHUNK_PAIRS, sums=None):
+    """ PSF resolution on a hemisphere grid of the given sampling, refined
+    coarse-to-fine.
+
+    The resolution is first evaluated on a coarse grid, and the cells of
+    the finer grids are interpolated from the evaluated directions (see
+    _interpolationWeights). At each finer level (half the sampling of the
+    previous one) the interpolation error of every evaluated direction is
+    estimated by leaving it out, and only the cells for which any of the
+    directions they are interpolated from has an error above half the
+    tolerance (A) are evaluated. Features narrower than the coarse
+    sampling can not be detected.
+
+    Returns the fine grid, the resolution of every cell and, for every
+    cell, the indexes of the evaluated directions (in evaluation order,
+    which is also the order of the sums appended to the sums list if
+    given) and the weights it is interpolated with (see interpolate).
+    """
+    gridClass = type(histGrid)
+    levels = [float(sampling)]
+    while levels[-1] * 2 <= coarseSampling:
+        levels.append(levels[-1] * 2)
+    levels.reverse()
+
+    grid = gridClass(levels[0], hemisphere=True)
+    points = grid.directions
+    values = directionResolution(model, hist, histGrid, points, chunkPairs,
+                                 sums)
+
+    for level in levels[1:]:
+        rows, weights = _interpolationWeights(points, points, leaveOut=True)
+        error = np.abs(interpolate(values, rows, weights) - values)
+        grid = gridClass(level, hemisphere=True)
+        rows, _ = _interpolationWeights(points, grid.directions)
+        cells = np.flatnonzero(error[rows].max(axis=1) > tolerance / 2)
+        if len(cells):
+            points = np.concatenate([points, grid.directions[cells]])
+            values = np.concatenate([values, directionResolution(
+                model, hist, histGrid, grid.directions[cells], chunkPairs,
+                sums)])
+
+    rows, weights = _interpolationWeights(points, grid.directions)
+    return grid, interpolate(values, rows, weights), rows, weights
+
+
+def sumsResolution(model, sums, rows=None, chunkPairs=CHUNK_PAIRS,
+                   weights=None):
+    """ PSF resolution from stored geometric sums (nDirections x
+    THETA_BINS), e.g. to evaluate other PSF model parameters without
+    recomputing the geometry. The sums are evaluated in blocks of at most
+    chunkPairs direction/frequency pairs, and interpolated to the grid
+    cells with rows and weights if given (see adaptiveResolution). """
+    step = max(1, chunkPairs // model.nFreq)
+    res = np.concatenate([model.resolution(sums[start:start + step])
+                          for start in range(0, len(sums), step)])
+    return interpolate(res, rows, weights)
+
+
+def coverageCompleteness(model, sums, freqs, rows=None, threshold=0.5,
+                         chunkPairs=CHUNK_PAIRS, weights=None):
+    """ Completeness of the Fourier space coverage in resolution shells.
+
+    The coverage of every direction at all the shell frequencies is
+    obtained in one product of the geometric sums with the slab profiles
+    of the shells (PSFModel.coverage), and divided by the coverage of a
+    uniform distribution of the same particles. The directions are
+    weighted by the share of the grid cells interpolated from them (rows
+    and weights, see adaptiveResolution), at most chunkPairs
+    direction/frequency pairs being evaluated at once.
+
+    Returns, for every shell, the fraction of directions whose relative
+    coverage reaches threshold. The mean relative coverage of a shell is
+    always 1, as every section adds the same coverage to each shell.
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    if rows is None:
+        share = np.ones(len(sums))
+    else:
+        rows = np.reshape(rows, (len(rows), -1))
+        cellWeights = np.ones(rows.shape) if weights is None else \
+            np.clip(np.reshape(weights, rows.shape), 0, None)
+        cellWeights /= cellWeights.sum(axis=1, keepdims=True)
+        share = np.bincount(rows.ravel(), weights=cellWeights.ravel(),
+                            minlength=len(sums))
+    share /= share.sum()
+    uniform = model.uniformCoverage(freqs)
+    completeness = np.zeros(len(freqs))
+    step = max(1, chunkPairs // max(1, len(freqs)))
+
+    for start in range(0, len(sums), step):
+        block = np.asarray(sums[start:start + step], dtype=np.float64)
+        relative = model.coverage(block, freqs) / (
+            block.sum(axis=-1, keepdims=True) * uniform)
+        completeness += share[start:start + step].dot(relative >= threshold)
+
+    return completeness
+
+
+def _halfToFull(half, boxSize):
+    """ Expand a real-to-complex half volume (b x b x b/2+1) to the full
+    Fourier volume using its Hermitian symmetry. A real half volume (e.g.
+    the magnitude) is mirrored as is. """
+    full = np.empty((boxSize,) * 3, dtype=half.dtype)
+    nx = half.shape[2]
+    full[:, :, :nx] = half
+    neg = -np.arange(boxSize) % boxSize
+    cols = boxSize - np.arange(nx, boxSize)
+    full[:, :, nx:] = half[neg][:, neg][:, :, cols]
+    if np.iscomplexobj(full):
+        np.conj(full[:, :, nx:], out=full[:, :, nx:])
+    return full
+
+
+def psfVolumes(hist, grid, boxSize, pixelSize, model, threads=1):
+    """ Real space PSF and Fourier space coverage volumes of a histogram
+    of orientations (cells of a hemisphere grid).
+
+    The central sections of all occupied cells are accumulated through
+    their real space counterpart (Fourier slice theorem): a line along
+    the projection direction whose length is the particle diameter, which
+    gives each section its thickness. A real-to-complex FFT of the lines
+    gives the coverage half volume, which is multiplied by the B-factor
+    envelope and transformed back to obtain the PSF. Both transforms use
+    scipy.fft with the given number of threads.
+
+    Returns the (R, K) volumes centered in the box, as float32.
+    """
+    from scipy import fft
+
+    cells = np.flatnonzero(hist)
+    weights = hist[cells] / max(hist.sum(), 1)
+    center = boxSize // 2
+    length = min(model.diameter / (2.0 * pixelSize), center - 1)
+    steps = np.arange(-length, length + 0.25, 0.5)
+    shape = (boxSize,) * 3
+    lines = np.zeros(boxSize ** 3, dtype=np.float32)
+    chunk = max(1, CHUNK_PAIRS // (8 * len(steps)))
+
+    for start in range(0, len(cells), chunk):
+        dirs = grid.directions[cells[start:start + chunk]]
+        w = np.repeat(weights[start:start + chunk], len(steps))
+        # z, y, x voxel coordinates of the line points
+        points = (steps[None, :, None] * dirs[:, None, ::-1]).reshape(-1, 3)
+        points += center
+        base = np.floor(points).astype(np.int64)
+        frac = points - base
+        flat = np.empty((8, len(points)), dtype=np.int64)
+        values = np.empty((8, len(points)))
+        for i, corner in enumerate(np.ndindex(2, 2, 2)):
+            flat[i] = np.ravel_multi_index((base + corner).T, shape,
+                                           mode='clip')
+            values[i] = w * np.prod(np.where(corner, frac, 1 - frac), axis=1)
+        # only the span of voxels reached by the lines is counted
+        first, last = flat.min(), flat.max() + 1
+        flat -= first
+        lines[first:last] += np.bincount(flat.ravel(), values.ravel(),
+                                         minlength=last - first)
+    if len(cells):
+        del points, base, frac, flat, values
+
+    lines = fft.ifftshift(lines.reshape(shape))
+    coverage = fft.rfftn(lines, workers=threads)
+    del lines
+
+    # The magnitude is Hermitian symmetric as well, so only the real half
+    # volume is expanded to the full box
+    magnitude = np.abs(coverage).astype(np.float32)
+    # The B-factor envelope exp(-B f^2 / 4) is the outer product of one
+    # exponential per axis, applied in place without a frequency volume
+    freqs = [fft.fftfreq(boxSize, d=pixelSize)] * 2 + [
+        fft.rfftfreq(boxSize, d=pixelSize)]
+    for axis, f in enumerate(freqs):
+        factor = np.exp(-model.bfactor * f ** 2 / 4).astype(np.float32)
+        coverage *= factor.reshape([-1 if i == axis else 1
+                                    for i in range(3)])
+    psf = fft.irfftn(coverage, s=(boxSize,) * 3, workers=threads)
+    del coverage
+    psf = fft.fftshift(psf).astype(np.float32, copy=False)
+    magnitude = fft.fftshift(_halfToFull(magnitude, boxSize))
+    magnitude /= max(magnitude.max(), 1e-12)
+
+    return psf, magnitude
+
+
+def radialProfile(image):
+    """ Rotational average of a 2D image around its center. """
+    image = np.asarray(image, dtype=np.float64)
+    y, x = np.indices(image.shape)
+    r = np.hypot(x - image.shape[1] // 2, y - image.shape[0] // 2)
+    r = r.astype(np.int64)
+    counts = np.bincount(r.ravel())
+    return np.bincount(r.ravel(), weights=image.ravel()) / np.maximum(counts, 1)
+
+
+def estimateDiameter(image, samplingRate, threshold=0.1):
+    """ Estimate the particle diameter (A) from an averaged particle image,
+    as the radius where the radial profile falls to threshold times its
+    peak contrast over the background. Return None if no particle is
+    detected. """
+    profile = radialProfile(image)[:min(image.shape) // 2]
+    if len(profile) < 4:
+        return None
+    background = profile[int(0.9 * len(profile)):].mean()
+    contrast = np.abs(profile - background)
+    peak = contrast.argmax()
+    if contrast[peak] <= 0:
+        return None
+    below = np.flatnonzero(contrast[peak:] < threshold * contrast[peak])
+    radius = peak + below[0] if len(below) else len(profile)
+    return 2 * radius * samplingRate
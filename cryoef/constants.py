@@ -26,6 +26,14 @@
 
 CRYOEF_HOME = 'CRYOEF_HOME'
 
+# PSF computation
+PSF_CRYOEF = 0
+PSF_PLUGIN = 1
+
+# Weighted particles output
+WEIGHTS_ALL = 0
+WEIGHTS_SUBSET = 1
+
 # Viewer constants
 VOL_RS_PSF = 0
 VOL_FS_PSF = 1
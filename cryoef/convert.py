@@ -25,6 +25,9 @@
 # **************************************************************************
 
 import os
+import re
+import sqlite3
+import numpy as np
 from numpy import rad2deg
 from numpy.linalg import inv
 
@@ -52,18 +55,335 @@ def parseOutput(filename):
     return map(float, result)
 
 
-def iterAngles(fn):
-    with open(fn) as f:
-        for line in f:
-            rot, tilt = map(float, line.split())
-            yield rot, tilt
+def writeOutput(filename, efficiency, meanRes, stdev, worstRes, bestRes):
+    """ Write the analysis results in the same format as the cryoEF log,
+    so they can be read back with parseOutput. """
+    with open(filename, 'w') as f:
+        f.write("Efficiency: %0.4f\n" % efficiency)
+        f.write("Mean PSF resolution: %0.4f\n" % meanRes)
+        f.write("Standard deviation: %0.4f\n" % stdev)
+        f.write("Worst PSF resolution: %0.4f\n" % worstRes)
+        f.write("Best PSF resolution: %0.4f\n" % bestRes)
 
 
-def writeAnglesFn(img, fn):
-    # get alignment parameters for each particle
-    angles = geometryFromMatrix(img.getTransform().getMatrix())
-    rot, tilt, _ = angles
-    fn.write("%0.6f %0.6f\n" % (rot, tilt))
+# Progress lines of cryoEF: a percentage alone on its line, optionally
+# after a "Progress" label or a bar, or a count of processed particles or
+# projections. Other numbers in the output (steps, symmetry operators,
+# paths) are not progress markers.
+PROGRESS_PERCENT = re.compile(
+    r'^\s*(?:progress\s*:?)?[\s\[\]#=>*.-]*(\d+(?:\.\d+)?)\s*%'
+    r'\s*(?:done|completed?)?[\s.]*$', re.IGNORECASE)
+PROGRESS_COUNT = re.compile(
+    r'^\s*(?:\w+\s+)?(\d+)\s*(?:/|of)\s*(\d+)\s+'
+    r'(?:particles|projections|orientations)\b', re.IGNORECASE)
+
+
+def parseProgress(line):
+    """ Return the completed fraction (0-1) reported by a progress line of
+    the cryoEF output: a percentage, or a count of processed particles as
+    "done/total particles" or "done of total particles". Return None for
+    any other line.
+    """
+    match = PROGRESS_PERCENT.match(line)
+    if match:
+        return min(float(match.group(1)) / 100., 1.)
+    match = PROGRESS_COUNT.match(line)
+    if match:
+        done, total = map(int, match.groups())
+        if total > 0 and done <= total:
+            return done / total
+    return None
+
+
+# Attribute labels of the particle columns read from the set sqlite
+TRANSFORM_LABEL = '_transform._matrix'
+MIC_ID_LABEL = '_micId'
+COORD_X_LABEL = '_coordinate._x'
+COORD_Y_LABEL = '_coordinate._y'
+
+
+def iterSetColumns(dbName, labels, chunkSize=None):
+    """ Read attribute columns of the items of a Scipion set with a single
+    query on its sqlite file, instead of building one object per item.
+    The column of each attribute label is looked up in the Classes table.
+
+    Yields, for each chunk of at most chunkSize items (all of them if
+    None), a dict with the item ids (as 'id') and the raw values of each
+    label, or None for the labels the set does not have.
+    """
+    conn = sqlite3.connect('file:%s?mode=ro' % dbName, uri=True)
+    try:
+        mapping = dict(conn.execute(
+            'SELECT label_property, column_name FROM Classes'))
+        present = [label for label in labels if label in mapping]
+        cursor = conn.execute('SELECT %s FROM Objects ORDER BY id' % ', '.join(
+            ['id'] + [mapping[label] for label in present]))
+        while True:
+            rows = cursor.fetchmany(chunkSize) if chunkSize else \
+                cursor.fetchall()
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            result = {label: None for label in labels}
+            result.update(zip(present, columns[1:]))
+            result['id'] = np.array(columns[0], dtype=np.int64)
+            del rows, columns
+            yield result
+    finally:
+        conn.close()
+
+
+def countSetItems(dbName):
+    """ Number of items of a Scipion set sqlite. """
+    conn = sqlite3.connect('file:%s?mode=ro' % dbName, uri=True)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM Objects').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def addSetColumn(dbName, label, className, chunks):
+    """ Add an attribute column (e.g. a Float) to the items of a Scipion
+    set sqlite, filling it with one bulk update per (ids, values) chunk. """
+    conn = sqlite3.connect(dbName)
+    try:
+        columns = [row[0] for row in conn.execute(
+            'SELECT column_name FROM Classes')]
+        numbers = [int(c[1:]) for c in columns if re.match(r'c\d+$', c)]
+        column = 'c%02d' % (max(numbers, default=-1) + 1)
+        conn.execute('ALTER TABLE Objects ADD COLUMN %s' % column)
+        conn.execute('INSERT INTO Classes (label_property, column_name, '
+                     'class_name) VALUES (?, ?, ?)', (label, column, className))
+        for ids, values in chunks:
+            conn.executemany('UPDATE Objects SET %s=? WHERE id=?' % column,
+                             zip(np.asarray(values).tolist(),
+                                 np.asarray(ids).tolist()))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def deleteSetItems(dbName, idChunks):
+    """ Remove items from a Scipion set sqlite, with one bulk delete per
+    chunk of ids. """
+    conn = sqlite3.connect(dbName)
+    try:
+        for ids in idChunks:
+            conn.executemany('DELETE FROM Objects WHERE id=?',
+                             ((i,) for i in np.asarray(ids).tolist()))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def parseMatrices(values):
+    """ Parse transformation matrices stored as text ("[[..], [..]]")
+    into an (N x 4 x 4) array with a single numpy call. """
+    text = ','.join(values).replace('[', '').replace(']', '')
+    return np.fromstring(text, sep=',').reshape(-1, 4, 4)
+
+
+class AngleSet:
+    """ Compact container of projection angles (rot, tilt in degrees).
+
+    Angles are kept in a single contiguous float32 array of shape (2, N),
+    so each angle is a contiguous row and slicing returns views without
+    copying data. The text format is the one expected by cryoEF (one
+    "rot tilt" line per particle) and the binary one is a .npy file that
+    can be memory-mapped.
+    """
+    __slots__ = ('_data',)
+
+    TEXT_CHUNK = 100000
+
+    def __init__(self, rot=(), tilt=()):
+        self._data = np.vstack([np.asarray(rot, dtype=np.float32),
+                                np.asarray(tilt, dtype=np.float32)])
+
+    @classmethod
+    def _fromData(cls, data):
+        angles = cls.__new__(cls)
+        angles._data = data
+        return angles
+
+    @property
+    def rot(self):
+        return self._data[0]
+
+    @property
+    def tilt(self):
+        return self._data[1]
+
+    def __len__(self):
+        return self._data.shape[1]
+
+    def __getitem__(self, key):
+        """ Basic slices return views sharing memory with this set. """
+        if isinstance(key, (int, np.integer)):
+            return float(self.rot[key]), float(self.tilt[key])
+        return self._fromData(self._data[:, key])
+
+    def __iter__(self):
+        """ Iterate over (rot, tilt) tuples. """
+        for block in self.iterChunks(self.TEXT_CHUNK):
+            yield from zip(block.rot.tolist(), block.tilt.tolist())
+
+    def iterChunks(self, chunkSize=None):
+        """ Iterate over views of at most chunkSize angles. Chunks of a
+        memory-mapped set are only read when used. """
+        chunkSize = chunkSize or max(len(self), 1)
+        for start in range(0, len(self), chunkSize):
+            yield self[start:start + chunkSize]
+
+    @classmethod
+    def from_matrices(cls, matrices):
+        """ Create the set from a stack of transformation matrices
+        (N x 4 x 4 or N x 3 x 3), vectorized equivalent of calling
+        geometryFromMatrix for each of them.
+        """
+        matrices = np.asarray(matrices, dtype=np.float64)
+        m = inv(matrices)[:, :3, :3]
+        sy = np.hypot(m[:, 2, 1], m[:, 2, 0])
+        regular = sy > np.finfo(float).eps * 4.0
+        rot = np.where(regular,
+                       np.arctan2(m[:, 2, 1], m[:, 2, 0]),
+                       np.arctan2(-m[:, 1, 0], m[:, 1, 1]))
+        tilt = np.arctan2(sy, m[:, 2, 2])
+        return cls(np.degrees(rot), np.degrees(tilt))
+
+    @classmethod
+    def fromParticles(cls, partSet):
+        """ Create the set from the alignment of a SetOfParticles. """
+        chunks = list(cls.iterParticles(partSet))
+        return cls.concat(chunks) if chunks else cls()
+
+    @classmethod
+    def iterParticles(cls, partSet, chunkSize=None):
+        """ Yield the angles of a SetOfParticles in chunks of at most
+        chunkSize particles, in id order.
+
+        The matrices are read as a column of the set sqlite; sets without
+        a file are iterated item by item.
+        """
+        dbName = partSet.getFileName()
+        if dbName and os.path.exists(dbName):
+            yield from cls.iterSqlite(dbName, chunkSize)
+            return
+
+        chunkSize = chunkSize or partSet.getSize()
+        matrices = []
+        for part in partSet.iterItems():
+            matrices.append(part.getTransform().getMatrix())
+            if len(matrices) == chunkSize:
+                yield cls.from_matrices(matrices)
+                matrices = []
+        if matrices:
+            yield cls.from_matrices(matrices)
+
+    @classmethod
+    def iterSqlite(cls, dbName, chunkSize=None):
+        """ Yield the angles of the particles of a set sqlite in chunks of
+        at most chunkSize particles. Raise ValueError if some particles
+        have no transformation. """
+        for columns in iterSetColumns(dbName, [TRANSFORM_LABEL], chunkSize):
+            matrices = columns[TRANSFORM_LABEL]
+            if matrices is None or None in matrices:
+                raise ValueError('Missing particle transformations in %s'
+                                 % dbName)
+            yield cls.from_matrices(parseMatrices(matrices))
+
+    @classmethod
+    def concat(cls, angleSets):
+        """ Join several sets into a new one. """
+        return cls._fromData(np.concatenate([a._data for a in angleSets],
+                                            axis=1))
+
+    def to_vectors(self):
+        """ Return the unit projection directions (N x 3). """
+        return anglesToVectors(self.rot, self.tilt)
+
+    def sample(self, size, seed=None):
+        """ Return a random subset of at most size angles, keeping the
+        original order. """
+        if size >= len(self):
+            return self
+        rng = np.random.default_rng(seed)
+        index = np.sort(rng.choice(len(self), size, replace=False))
+        return self._fromData(self._data[:, index])
+
+    def write(self, fn, append=False):
+        """ Write the angles in cryoEF text format. """
+        with open(fn, 'a' if append else 'w') as f:
+            for start in range(0, len(self), self.TEXT_CHUNK):
+                block = self._data[:, start:start + self.TEXT_CHUNK]
+                values = block.T.ravel().tolist()
+                f.write("%0.6f %0.6f\n" * block.shape[1] % tuple(values))
+
+    @classmethod
+    def read(cls, fn):
+        """ Read angles from a cryoEF text file. """
+        values = np.fromfile(fn, dtype=np.float32, sep=' ')
+        return cls._fromData(np.ascontiguousarray(values.reshape(-1, 2).T))
+
+    def save(self, fn):
+        """ Save the angles in binary (.npy) format. """
+        np.save(fn, self._data)
+
+    @classmethod
+    def load(cls, fn, mmap=False):
+        """ Load angles saved in binary format, optionally memory-mapped. """
+        return cls._fromData(np.load(fn, mmap_mode='r' if mmap else None))
+
+
+def writeAngleFiles(angleChunks, size, textFn, binFn):
+    """ Write chunks of angles (AngleSet) to the cryoEF text file and to
+    the binary (.npy) file, which is filled through a memory map so that
+    only one chunk is held in memory. Return the memory-mapped AngleSet.
+    """
+    data = np.lib.format.open_memmap(binFn, mode='w+', dtype=np.float32,
+                                     shape=(2, size))
+    open(textFn, 'w').close()
+    start = 0
+    for angles in angleChunks:
+        data[:, start:start + len(angles)] = angles._data
+        angles.write(textFn, append=True)
+        start += len(angles)
+    data.flush()
+    del data
+    if start != size:
+        raise ValueError('Expected %d angles, %d were converted.'
+                         % (size, start))
+    return AngleSet.load(binFn, mmap=True)
+
+
+def writeOrientationIndex(chunks, size, idsFn, cellsFn):
+    """ Write chunks of (ids, cells) of the particles to the .npy files of
+    an orientation index: the particle ids (int64) and the grid cell of
+    their orientation (uint16), filled through memory maps. The index is
+    sorted by id if the chunks were not. Return the memory-mapped arrays.
+    """
+    ids = np.lib.format.open_memmap(idsFn, mode='w+', dtype=np.int64,
+                                    shape=(size,))
+    cells = np.lib.format.open_memmap(cellsFn, mode='w+', dtype=np.uint16,
+                                      shape=(size,))
+    start = 0
+    for chunkIds, chunkCells in chunks:
+        if chunkCells.max(initial=0) > np.iinfo(np.uint16).max:
+            raise ValueError('The orientation grid has too many cells for '
+                             'the index.')
+        ids[start:start + len(chunkIds)] = chunkIds
+        cells[start:start + len(chunkIds)] = chunkCells
+        start += len(chunkIds)
+    if start != size:
+        raise ValueError('Expected %d particles, %d were indexed.'
+                         % (size, start))
+    if np.any(ids[1:] < ids[:-1]):
+        order = np.argsort(ids, kind='stable')
+        ids[:], cells[:] = ids[order], cells[order]
+    ids.flush()
+    cells.flush()
+    del ids, cells
+    return (np.load(idsFn, mmap_mode='r'), np.load(cellsFn, mmap_mode='r'))
 
 
 def geometryFromMatrix(matrix):
@@ -73,3 +393,135 @@ def geometryFromMatrix(matrix):
     angles = -rad2deg(euler_from_matrix(matrix, axes='szyz'))
 
     return angles
+
+
+def anglesToVectors(rot, tilt):
+    """ Return the unit projection directions (N x 3) for the given
+    rot and tilt angles in degrees.
+    """
+    rot = np.radians(rot)
+    tilt = np.radians(tilt)
+    sinTilt = np.sin(tilt)
+    return np.column_stack([np.cos(rot) * sinTilt,
+                            np.sin(rot) * sinTilt,
+                            np.cos(tilt)])
+
+
+class SphereGrid:
+    """ Equal-area pixelization of the sphere (or of the upper hemisphere
+    when antipodal directions are equivalent).
+
+    The sphere is split in latitude bands of roughly angSampling degrees
+    and every band is split in longitude so that cells are close to
+    square. Band edges are then adjusted in z so that every cell covers
+    exactly the same solid angle.
+    """
+    def __init__(self, angSampling=5.0, hemisphere=False):
+        self.angSampling = float(angSampling)
+        self.hemisphere = hemisphere
+        step = np.radians(self.angSampling)
+        thetaMax = np.pi / 2 if hemisphere else np.pi
+        nBands = max(1, int(round(thetaMax / step)))
+        thetaEdges = np.linspace(0, thetaMax, nBands + 1)
+        thetaCenters = (thetaEdges[:-1] + thetaEdges[1:]) / 2
+        self.nPhi = np.maximum(1, np.round(2 * np.pi * np.sin(thetaCenters) /
+                                           step)).astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.nPhi)])
+        self.size = int(self.offsets[-1])
+        zMin = 0.0 if hemisphere else -1.0
+        self.zEdges = 1.0 - self.offsets * (1.0 - zMin) / self.size
+        self.cellArea = 2 * np.pi * (1.0 - zMin) / self.size
+
+        band = np.repeat(np.arange(nBands), self.nPhi)
+        cell = np.arange(self.size) - self.offsets[band]
+        z = (self.zEdges[band] + self.zEdges[band + 1]) / 2
+        phi = (cell + 0.5) * 2 * np.pi / self.nPhi[band]
+        r = np.sqrt(1 - z ** 2)
+        self.directions = np.column_stack([r * np.cos(phi),
+                                           r * np.sin(phi), z])
+
+    def __len__(self):
+        return self.size
+
+    def getAngles(self):
+        """ Return rot and tilt (degrees) of the cell centers. """
+        x, y, z = self.directions.T
+        return (np.degrees(np.arctan2(y, x)),
+                np.degrees(np.arccos(np.clip(z, -1, 1))))
+
+    def getIndex(self, vectors):
+        """ Return the cell index of each unit vector (N x 3). """
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, 3)
+        x, y, z = vectors.T
+        if self.hemisphere:
+            flip = z < 0
+            x = np.where(flip, -x, x)
+            y = np.where(flip, -y, y)
+            z = np.abs(z)
+        nBands = len(self.nPhi)
+        band = np.searchsorted(-self.zEdges, -z, side='right') - 1
+        band = np.clip(band, 0, nBands - 1)
+        phi = np.mod(np.arctan2(y, x), 2 * np.pi)
+        nPhi = self.nPhi[band]
+        cell = np.minimum((phi * nPhi / (2 * np.pi)).astype(np.int64), nPhi - 1)
+        return self.offsets[band] + cell
+
+    def histogram(self, vectors, weights=None):
+        """ Count (or sum weights of) the vectors falling in each cell. """
+        return np.bincount(self.getIndex(vectors), weights=weights,
+                           minlength=self.size).astype(np.float64)
+
+    def angularDistances(self):
+        """ Return the matrix of great-circle distances (degrees)
+        between cell centers. """
+        cos = self.directions.dot(self.directions.T)
+        if self.hemisphere:
+            cos = np.abs(cos)
+        return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+class ResolutionMap:
+    """ PSF resolution (A) along every direction of an equal-area
+    SphereGrid, stored as float32.
+
+    The .npz file holds the resolution of every cell ('resolution') and
+    the pixelization needed to index it without this class: the grid
+    sampling ('angSampling'), whether it covers a hemisphere, the number
+    of cells of each latitude band ('nPhi') and the z edges of the bands
+    ('zEdges'). The cell of a unit direction is its position in longitude
+    within the band of its z, after the cells of the previous bands; on a
+    hemisphere grid antipodal directions share a cell.
+    """
+    def __init__(self, grid, resolution):
+        self.grid = grid
+        self.resolution = np.asarray(resolution, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.resolution)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            grid = SphereGrid(float(data['angSampling']),
+                              hemisphere=bool(data['hemisphere']))
+            if not np.array_equal(grid.nPhi, data['nPhi']):
+                raise ValueError('Unknown pixelization of %s.' % fn)
+            return cls(grid, data['resolution'])
+
+    def write(self, fn):
+        np.savez(fn, resolution=self.resolution,
+                 angSampling=self.grid.angSampling,
+                 hemisphere=self.grid.hemisphere,
+                 nPhi=self.grid.nPhi.astype(np.int32),
+                 zEdges=self.grid.zEdges)
+
+    def lookupVectors(self, vectors):
+        """ Resolution along unit directions (N x 3). """
+        return self.resolution[self.grid.getIndex(vectors)]
+
+    def lookup(self, rot, tilt):
+        """ Resolution along the projection directions of rot and tilt
+        angles (degrees), arrays of any (broadcastable) shape. """
+        rot, tilt = np.broadcast_arrays(rot, tilt)
+        return self.lookupVectors(anglesToVectors(
+            rot.ravel(), tilt.ravel())).reshape(rot.shape)
@@ -25,3 +25,4 @@
 # **************************************************************************
 
 from .protocol_cryoef import ProtCryoEF
+from .protocol_compare import ProtCryoEFCompare
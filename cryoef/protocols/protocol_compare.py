@@ -0,0 +1,281 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import os
+import numpy as np
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+from pwem.objects import Volume, SetOfVolumes
+
+from .protocol_cryoef import ProtCryoEFBase
+from ..convert import parseOutput, SphereGrid
+from ..analysis import angleHistogram, jensenShannon, sphereEMD, coverageGap
+
+
+class ProtCryoEFCompare(ProtCryoEFBase):
+    """ Compare the orientation distributions of two or more particle sets.
+
+    The first set is used as reference. Each set is analysed with cryoEF
+    and binned on a shared sphere grid, then Jensen-Shannon divergence,
+    earth mover's distance, coverage gaps and the efficiency difference
+    are computed against the reference.
+    """
+    _label = 'compare orientations'
+    _devStatus = BETA
+    _possibleOutputs = {'outputVolumes': SetOfVolumes}
+    stepsExecutionMode = STEPS_PARALLEL
+    # Approximate memory (bytes) per pair of grid cells of the dense
+    # transport matrices of the earth mover's distance (cost, kernel,
+    # their product and temporaries)
+    BYTES_PER_CELL_PAIR = 32
+
+    def __init__(self, **kwargs):
+        ProtCryoEFBase.__init__(self, **kwargs)
+
+    def _initialize(self):
+        self._createFilenameTemplates()
+
+    def _createFilenameTemplates(self):
+        """ Centralize how files are called. """
+        myDict = {
+            'anglesFn': self._getExtraPath('set%(set)02d', 'input_angles.dat'),
+            'anglesBin': self._getExtraPath('set%(set)02d', 'input_angles.npy'),
+            'output_log': self._getExtraPath('set%(set)02d', 'input_angles.log'),
+            'fourier space PSF': self._getExtraPath('set%(set)02d',
+                                                    'input_angles_K.mrc'),
+            'histogram': self._getExtraPath('set%(set)02d', 'histogram.npy'),
+            'progress': self._getExtraPath('set%(set)02d', 'progress.json'),
+            'difference PSF': self._getExtraPath('diff_set%(set)02d_K.mrc'),
+            'comparison': self._getExtraPath('comparison.npz')
+        }
+
+        self._updateFilenamesDict(myDict)
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputSets', params.MultiPointerParam,
+                      pointerClass='SetOfParticles',
+                      pointerCondition='hasAlignmentProj',
+                      label="Input particle sets", important=True,
+                      help='Provide two or more particle sets with angular '
+                           'information. The first one is the reference '
+                           'the others are compared to.')
+        form.addParam('angSampling', params.FloatParam, default=5.0,
+                      label='Sphere grid sampling (deg)',
+                      help='Angular size of the cells of the sphere grid '
+                           'used to bin the orientations of all sets.')
+        form.addParam('minDensity', params.FloatParam, default=0.1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Coverage threshold',
+                      help='A grid cell is considered covered when its '
+                           'density is at least this fraction of the density '
+                           'of a uniform distribution.')
+        self._defineAnalysisParams(form)
+        form.addParallelSection(threads=3, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+
+    def _insertAllSteps(self):
+        self._initialize()
+        deps = []
+        for i in range(len(self.inputSets)):
+            convertId = self._insertFunctionStep('convertInputStep', i,
+                                                 prerequisites=[])
+            deps.append(self._insertFunctionStep('runCryoEFStep', i,
+                                                 prerequisites=[convertId]))
+        compareId = self._insertFunctionStep('compareStep',
+                                             prerequisites=deps)
+        self._insertFunctionStep('createOutputStep',
+                                 prerequisites=[compareId])
+
+    # --------------------------- STEPS functions -----------------------------
+
+    def convertInputStep(self, index):
+        """ Convert input angles and bin them on the shared sphere grid. """
+        anglesFn = self._getFileName('anglesFn', set=index)
+        pwutils.makePath(os.path.dirname(anglesFn))
+        angles = self._convertAngles(self._getInputSet(index), anglesFn,
+                                     self._getFileName('anglesBin', set=index))
+        np.save(self._getFileName('histogram', set=index),
+                angleHistogram(angles, self._getGrid(),
+                               self.symmetryGroup.get(),
+                               self._getChunkSize()))
+
+    def runCryoEFStep(self, index):
+        """ Call cryoEF for one of the input sets. """
+        partSet = self._getInputSet(index)
+        boxSize = partSet.getFirstItem().getXDim()
+        self._runCryoEF(self._getCryoEFArgs(
+            self._getFileName('anglesFn', set=index), boxSize),
+            nParticles=partSet.getSize(),
+            progressFn=self._getFileName('progress', set=index))
+
+    def compareStep(self):
+        """ Compute the distances of every set to the reference. """
+        n = len(self.inputSets)
+        grid = self._getGrid()
+        hists = np.stack([np.load(self._getFileName('histogram', set=i))
+                          for i in range(n)])
+        ref, others = hists[0], hists[1:]
+        minDensity = self.minDensity.get()
+        efficiency = np.array([self._getEfficiency(i) for i in range(n)])
+
+        for i in range(1, n):
+            self._writeDifferenceVolume(i)
+
+        np.savez(self._getFileName('comparison'),
+                 histograms=hists,
+                 angSampling=grid.angSampling,
+                 jensenShannon=jensenShannon(ref, others),
+                 emd=sphereEMD(ref, others, grid),
+                 coverageGap=coverageGap(ref, others, minDensity),
+                 efficiency=efficiency,
+                 efficiencyDelta=efficiency[1:] - efficiency[0])
+
+    def createOutputStep(self):
+        volumes = self._createSetOfVolumes()
+        volumes.setSamplingRate(self._getInputSet(0).getSamplingRate())
+
+        for i in range(1, len(self.inputSets)):
+            volFn = self._getFileName('difference PSF', set=i)
+            if os.path.exists(volFn):
+                vol = Volume()
+                vol.setFileName(volFn)
+                vol.setSamplingRate(volumes.getSamplingRate())
+                vol.setObjLabel('fourier space PSF difference: %s'
+                                % self._getSetLabel(i))
+                volumes.append(vol)
+
+        self._defineOutputs(outputVolumes=volumes)
+        for pointer in self.inputSets:
+            self._defineSourceRelation(pointer, volumes)
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _summary(self):
+        summary = []
+        self._initialize()
+        compFn = self._getFileName('comparison')
+
+        if os.path.exists(compFn):
+            results = np.load(compFn)
+            summary.append('Reference: %s, efficiency *%0.2f*'
+                           % (self._getSetLabel(0), results['efficiency'][0]))
+            for i in range(1, len(self.inputSets)):
+                gaps = results['coverageGap'][i - 1]
+                summary.append(
+                    '%s: efficiency delta *%+0.2f*, JS divergence %0.3f, '
+                    'EMD %0.1f deg, coverage lost/gained %d/%d cells'
+                    % (self._getSetLabel(i), results['efficiencyDelta'][i - 1],
+                       results['jensenShannon'][i - 1], results['emd'][i - 1],
+                       np.count_nonzero(gaps < 0), np.count_nonzero(gaps > 0)))
+        else:
+            summary.append("Output is not ready yet.")
+            summary.extend(self._getProgressSummary())
+
+        return summary
+
+    def _validate(self):
+        errors = []
+        if len(self.inputSets) < 2:
+            errors.append('Provide at least two particle sets: the '
+                          'reference and a set to compare with it.')
+        if self.angSampling.get() <= 0:
+            errors.append('Sphere grid sampling should be positive.')
+        else:
+            needed = (self._getGrid().size ** 2 * self.BYTES_PER_CELL_PAIR /
+                      2 ** 20)
+            if needed > self.memoryBudget.get():
+                errors.append('The earth mover\'s distance on this sphere '
+                              'grid needs about %d MB, more than the memory '
+                              'budget. Increase the sphere grid sampling.'
+                              % needed)
+
+        return errors
+
+    def _getProgressSummary(self):
+        """ Progress of the cryoEF job of every set, which run in
+        parallel and keep it in their own files. """
+        if not self.isActive():
+            return []
+        self._initialize()
+        summary = []
+        for i in range(len(self.inputSets)):
+            progressFn = self._getFileName('progress', set=i)
+            if os.path.exists(progressFn):
+                with open(progressFn) as f:
+                    progress = json.load(f)
+                summary.append(self._formatProgress(
+                    'cryoEF progress of %s' % self._getSetLabel(i),
+                    progress['progress'], progress['throughput'],
+                    progress['eta']))
+        return summary
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _getInputSet(self, index):
+        return self.inputSets[index].get()
+
+    def _getSetLabel(self, index):
+        label = self._getInputSet(index).getObjLabel()
+        return 'set %d%s' % (index + 1, ' (%s)' % label if label else '')
+
+    def _getGrid(self):
+        return SphereGrid(self.angSampling.get())
+
+    def _getEfficiency(self, index):
+        results = list(parseOutput(self._getFileName('output_log', set=index)))
+        return results[0] if results else np.nan
+
+    def _writeDifferenceVolume(self, index):
+        """ Write the difference between the normalized Fourier space
+        PSF of a set and the reference one. """
+        import mrcfile
+
+        refFn = self._getFileName('fourier space PSF', set=0)
+        volFn = self._getFileName('fourier space PSF', set=index)
+        with mrcfile.open(refFn, permissive=True) as mrc:
+            ref = mrc.data.astype(np.float32)
+            voxelSize = mrc.voxel_size.copy()
+        with mrcfile.open(volFn, permissive=True) as mrc:
+            vol = mrc.data.astype(np.float32)
+
+        if vol.shape != ref.shape:
+            self.info('Skipping PSF difference for %s: box size differs '
+                      'from the reference.' % self._getSetLabel(index))
+            return
+
+        diff = vol / max(vol.max(), 1e-12) - ref / max(ref.max(), 1e-12)
+        with mrcfile.new(self._getFileName('difference PSF', set=index),
+                         overwrite=True) as mrc:
+            mrc.set_data(diff)
+            mrc.voxel_size = voxelSize
@@ -24,27 +24,270 @@
 # *
 # **************************************************************************
 
+import glob
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+
 import pyworkflow.protocol.params as params
 from pyworkflow.constants import PROD
+from pyworkflow.object import Float, Integer, String
 from pwem.protocols import ProtAnalysis3D
-from pwem.objects import Volume
+from pwem.objects import (Volume, SetOfMicrographs, SetOfParticles,
+                          SetOfClasses)
 
 from cryoef import Plugin
-from ..convert import writeAnglesFn, parseOutput
+from ..constants import (PSF_CRYOEF, PSF_PLUGIN, WEIGHTS_ALL, WEIGHTS_SUBSET,
+                         VOL_RS_PSF)
+from ..convert import (AngleSet, SphereGrid, parseOutput, parseProgress,
+                       writeOutput, writeAngleFiles, writeOrientationIndex,
+                       ResolutionMap, iterSetColumns, addSetColumn, deleteSetItems,
+                       MIC_ID_LABEL, COORD_X_LABEL, COORD_Y_LABEL)
+from ..analysis import (PSFModel, angleHistogram, expandHistogram,
+                        fixedResolution, adaptiveResolution, psfVolumes,
+                        sumsResolution, OrientationIndex,
+                        coverageCompleteness,
+                        GroupHistograms, histogramScores,
+                        OrientationAccumulator,
+                        inverseDensityWeights, hashIds, flattenThresholds)
+
 
+class ProtCryoEFBase(ProtAnalysis3D):
+    """ Base class with the cryoEF parameters and execution
+    shared by the cryoEF protocols.
+    """
+    _label = None
+    # Seconds between two updates of the progress stored in the database
+    PROGRESS_INTERVAL = 5
+    # Approximate peak memory (bytes) per particle of the chunked steps,
+    # per direction/cell pair of the PSF engine and per PSF volume voxel
+    BYTES_PER_PARTICLE = 2048
+    BYTES_PER_PAIR = 48
+    BYTES_PER_VOXEL = 32
+
+    def __init__(self, **kwargs):
+        ProtAnalysis3D.__init__(self, **kwargs)
+        self.progress = Float()
+        self.throughput = Float()
+        self.eta = String()
 
-class ProtCryoEF(ProtAnalysis3D):
+    def _defineAnalysisParams(self, form):
+        form.addParam('symmetryGroup', params.StringParam, default='c1',
+                      label="Symmetry",
+                      help='If the molecule is asymmetric, set Symmetry group '
+                           'to C1. Look at the XMIPP Wiki for more details:'
+                           ' https://xmipp.cnb.csic.es/twiki/bin/view/Xmipp/'
+                           'WebHome?topic=Symmetry')
+        form.addParam('diam', params.IntParam, default=200,
+                      label='Particle diameter (A)',
+                      help='Approximate particle diameter, in Angstroms.')
+        form.addParam('angAcc', params.IntParam, default=1,
+                      label='Angular accuracy (deg)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Angular accuracy in degrees.')
+        form.addParam('Bfact', params.IntParam, default=160,
+                      label='B-factor (A^2)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='B-factor estimate for your data, if one was '
+                           'estimated for the 3D reconstruction.')
+        form.addParam('FSCres', params.FloatParam, default=-1,
+                      label='FSC resolution (A)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='FSC resolution using 0.143 criterion. '
+                           'Default (-1) value means that resolution will be '
+                           'automatically estimated from B-factor.')
+        form.addParam('maxTilt', params.IntParam, default=45,
+                      label='Max tilt angle (deg)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Maximum tilt angle allowed for prediction '
+                           'algorithm, in degrees.')
+        form.addParam('timeLimit', params.IntParam, default=0,
+                      label='Time limit (min)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Abort cryoEF if it runs for longer than this '
+                           'wall-clock time, in minutes. Use 0 for no limit.')
+        form.addParam('memoryBudget', params.IntParam, default=4096,
+                      label='Memory budget (MB)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Maximum memory used by the steps run in Scipion '
+                           '(conversion, histograms, weights and the plugin '
+                           'PSF engine). Particles are processed in chunks '
+                           'read from the set database and memory-mapped '
+                           'files, so large sets run on small nodes. It does '
+                           'not apply to the cryoEF program.')
+
+    def _getChunkSize(self, bytesPerItem=None):
+        """ Number of items processed at once so that a chunk uses at
+        most a quarter of the memory budget, leaving room for the arrays
+        that do not depend on the number of particles. """
+        bytesPerItem = bytesPerItem or self.BYTES_PER_PARTICLE
+        return max(1000, self.memoryBudget.get() * 2 ** 20 //
+                   (4 * bytesPerItem))
+
+    def _convertAngles(self, partSet, anglesFn, anglesBin):
+        """ Write the angles of a particle set to the cryoEF text file and
+        the binary file one chunk at a time, return them memory-mapped. """
+        chunks = AngleSet.iterParticles(partSet, self._getChunkSize())
+        return writeAngleFiles(chunks, partSet.getSize(), anglesFn, anglesBin)
+
+    def _getCryoEFArgs(self, anglesFn, boxSize):
+        """ Prepare the args dictionary for a given angles file. """
+        args = {'-f': anglesFn,
+                '-b': boxSize,
+                '-a': self.angAcc.get(),
+                '-B': self.Bfact.get(),
+                '-D': self.diam.get(),
+                '-g': self.symmetryGroup.get() or 'c1',
+                '-m': self.maxTilt.get()
+                }
+        if self.FSCres.get() != -1:
+            args['-r'] = self.FSCres.get()
+
+        return args
+
+    def _runCryoEF(self, args, nParticles=None, progressFn=None):
+        """ Call cryoEF with the args dictionary.
+
+        The program output is streamed into the protocol log while it runs.
+        Progress markers are parsed to store the completed fraction,
+        throughput (particles/s) and ETA in the protocol, or in the
+        progressFn json file if given (see _updateProgress), and the
+        process is terminated if it exceeds the time limit.
+        """
+        program = Plugin.getProgram()
+        cmd = [program] + [str(x) for item in args.items() for x in item]
+        self._runStreamed(cmd, nParticles, progressFn,
+                          timeLimit=self.timeLimit.get() * 60)
+
+    def _runStreamed(self, cmd, nParticles=None, progressFn=None,
+                     timeLimit=0):
+        """ Run cmd streaming its output and progress, see _runCryoEF.
+        The process is aborted after timeLimit seconds (0 for no limit).
+        Progress never goes back: only the largest fraction reported
+        is kept. """
+        self.info(' '.join(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   env=Plugin.getEnviron(),
+                                   universal_newlines=True, bufsize=1)
+        lines = queue.Queue()
+        reader = threading.Thread(target=self._readOutput,
+                                  args=(process.stdout, lines), daemon=True)
+        reader.start()
+
+        start = lastStore = time.time()
+        progress = 0.
+        self._updateProgress(progress, start, nParticles,
+                             progressFn=progressFn)
+        while reader.is_alive() or not lines.empty():
+            try:
+                line = lines.get(timeout=1)
+                self.info(line.rstrip())
+                fraction = parseProgress(line)
+                if fraction is not None and fraction > progress:
+                    progress = fraction
+                    store = time.time() - lastStore > self.PROGRESS_INTERVAL
+                    self._updateProgress(fraction, start, nParticles, store,
+                                         progressFn)
+                    if store:
+                        lastStore = time.time()
+            except queue.Empty:
+                pass
+            if timeLimit and time.time() - start > timeLimit:
+                self._terminate(process)
+                raise Exception('cryoEF was aborted after exceeding the time '
+                                'limit of %s.' % timedelta(seconds=timeLimit))
+
+        if process.wait() != 0:
+            raise Exception('cryoEF failed with exit code %d, check the '
+                            'protocol log.' % process.returncode)
+        self._updateProgress(1., start, nParticles, progressFn=progressFn)
+
+    @staticmethod
+    def _readOutput(stream, lines):
+        """ Push the lines of stream to a queue, run in a separate thread. """
+        for line in iter(stream.readline, ''):
+            lines.put(line)
+        stream.close()
+
+    @staticmethod
+    def _terminate(process, timeout=10):
+        process.terminate()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _updateProgress(self, fraction, start, nParticles=None, store=True,
+                        progressFn=None):
+        """ Set progress, throughput and ETA from the completed fraction.
+
+        Steps running in parallel threads can not write to the database
+        and would share the protocol attributes, so each of them passes a
+        progressFn where its own progress is written as json instead.
+        """
+        elapsed = max(time.time() - start, 1e-3)
+        throughput = nParticles * fraction / elapsed if nParticles else None
+        eta = None
+        if 0 < fraction < 1:
+            eta = str(timedelta(seconds=int(elapsed * (1 - fraction) /
+                                            fraction)))
+        if progressFn is not None:
+            if store:  # replaced at once so readers never see half a file
+                with open(progressFn + '.tmp', 'w') as f:
+                    json.dump({'progress': fraction, 'throughput': throughput,
+                               'eta': eta}, f)
+                os.replace(progressFn + '.tmp', progressFn)
+            return
+        self.progress.set(fraction)
+        self.throughput.set(throughput)
+        self.eta.set(eta)
+        if store and self.modeSerial():
+            self._store(self.progress, self.throughput, self.eta)
+
+    def _getProgressSummary(self):
+        """ Summary line with the progress of the running cryoEF job. """
+        if not self.isActive() or not self.progress.hasValue():
+            return []
+        return [self._formatProgress('cryoEF progress', self.progress.get(),
+                                     self.throughput.get(), self.eta.get())]
+
+    @staticmethod
+    def _formatProgress(label, progress, throughput=None, eta=None):
+        line = '%s: *%d%%*' % (label, 100 * progress)
+        if throughput is not None:
+            line += ', %0.0f particles/s' % throughput
+        if eta:
+            line += ', ETA %s' % eta
+        return line
+
+
+class ProtCryoEF(ProtCryoEFBase):
     """ Protocol for analysing the orientation distribution of single-particle EM data.
     """
     _label = 'orientation analysis'
     _devStatus = PROD
     _possibleOutputs = {
         'outputVolume1': Volume,
-        'outputVolume2': Volume
+        'outputVolume2': Volume,
+        'outputMicrographs': SetOfMicrographs,
+        'outputParticles': SetOfParticles
     }
+    # Frequency samples used to score the particles of each micrograph
+    MIC_FREQUENCIES = 64
 
     def __init__(self, **kwargs):
-        ProtAnalysis3D.__init__(self, **kwargs)
+        ProtCryoEFBase.__init__(self, **kwargs)
+        self._psfSums = None
+        self._orientationIndex = None
 
     def _initialize(self):
         """ This function is mean to be called after the
@@ -57,11 +300,21 @@ class ProtCryoEF(ProtAnalysis3D):
         """ Centralize how files are called. """
         myDict = {
                   'anglesFn': self._getExtraPath('input_angles.dat'),
-                  'projections': self._getExtraPath('input_projections.sqlite'),
+                  'anglesBin': self._getExtraPath('input_angles.npy'),
                   'output_log': self._getExtraPath('input_angles.log'),
                   'real space PSF': self._getExtraPath('input_angles_R.mrc'),
                   'fourier space PSF': self._getExtraPath('input_angles_K.mrc'),
-                  'output_hist': self._getExtraPath('input_angles_PSFres.dat')
+                  'output_hist': self._getExtraPath('input_angles_PSFres.dat'),
+                  'psf_hist': self._getExtraPath('psf_histogram.npy'),
+                  'psf_sums': self._getExtraPath('psf_sums.npz'),
+                  'res_map': self._getExtraPath('psf_resolution_map.npz'),
+                  'coverage_curve': self._getExtraPath('coverage_curve.npz'),
+                  'psf_volume': self._getExtraPath('psf_box%(box)d_%(kind)s.mrc'),
+                  'mic_stats': self._getExtraPath('micrograph_stats.npz'),
+                  'acq_curve': self._getExtraPath('acquisition_curve.npz'),
+                  'weighted_particles': self._getPath('particles_weighted.sqlite'),
+                  'index_ids': self._getExtraPath('index_ids.npy'),
+                  'index_cells': self._getExtraPath('index_cells.npy')
                   }
 
         self._updateFilenamesDict(myDict)
@@ -75,102 +328,487 @@ class ProtCryoEF(ProtAnalysis3D):
                       pointerCondition='hasAlignmentProj',
                       label="Input particles", important=True,
                       help='Provide input particles with angular information.')
-        form.addParam('symmetryGroup', params.StringParam, default='c1',
-                      label="Symmetry",
-                      help='If the molecule is asymmetric, set Symmetry group '
-                           'to C1. Look at the XMIPP Wiki for more details:'
-                           ' https://xmipp.cnb.csic.es/twiki/bin/view/Xmipp/'
-                           'WebHome?topic=Symmetry')
-        form.addParam('diam', params.IntParam, default=200,
-                      label='Particle diameter (A)',
-                      help='Approximate particle diameter, in Angstroms.')
-        form.addParam('angAcc', params.IntParam, default=1,
-                      label='Angular accuracy (deg)',
+        self._defineAnalysisParams(form)
+
+        form.addSection(label='PSF')
+        form.addParam('psfEngine', params.EnumParam,
+                      choices=['cryoEF program', 'plugin'],
+                      default=PSF_CRYOEF, display=params.EnumParam.DISPLAY_HLIST,
+                      label='Compute PSF with',
+                      help='*cryoEF program*: run the cryoEF binary.\n'
+                           '*plugin*: evaluate the PSF resolution in Scipion '
+                           'with a model of the Fourier space coverage. '
+                           'Directions can be sampled adaptively, refining '
+                           'only where the resolution changes quickly.')
+        form.addParam('psfSampling', params.FloatParam, default=2.0,
+                      condition='psfEngine==%d' % PSF_PLUGIN,
+                      label='Direction sampling (deg)',
+                      help='Angular sampling of the directions where the PSF '
+                           'resolution is evaluated, and of the grid used '
+                           'to bin the orientations.')
+        form.addParam('adaptiveSampling', params.BooleanParam, default=True,
+                      condition='psfEngine==%d' % PSF_PLUGIN,
+                      label='Adaptive sampling?',
+                      help='Evaluate a coarse grid of directions first, '
+                           'interpolate the finer grids from it and evaluate '
+                           'only the directions where the interpolation '
+                           'error may exceed the tolerance.')
+        form.addParam('psfTolerance', params.FloatParam, default=0.1,
+                      condition='psfEngine==%d and adaptiveSampling'
+                                % PSF_PLUGIN,
                       expertLevel=params.LEVEL_ADVANCED,
-                      help='Angular accuracy in degrees.')
-        form.addParam('Bfact', params.IntParam, default=160,
-                      label='B-factor (A^2)',
+                      label='Tolerance (A)',
+                      help='Maximum expected difference between the '
+                           'interpolated and the evaluated PSF resolution '
+                           'of a direction.')
+        form.addParam('coverageThreshold', params.FloatParam, default=0.5,
+                      condition='psfEngine==%d' % PSF_PLUGIN,
                       expertLevel=params.LEVEL_ADVANCED,
-                      help='B-factor estimate for your data, if one was '
-                           'estimated for the 3D reconstruction.')
-        form.addParam('FSCres', params.FloatParam, default=-1,
-                      label='FSC resolution (A)',
+                      label='Coverage threshold',
+                      help='A direction of a resolution shell counts as '
+                           'covered when its Fourier space coverage reaches '
+                           'this fraction of the coverage of a uniform '
+                           'distribution of the same particles. The '
+                           'completeness of every shell up to Nyquist is '
+                           'plotted in the viewer.')
+        form.addParam('psfBoxSize', params.IntParam, default=-1,
+                      condition='psfEngine==%d' % PSF_PLUGIN,
+                      label='PSF volumes box size (px)',
+                      help='Box size of the output PSF volumes. Default (-1) '
+                           'uses the particle box size. A smaller box gives '
+                           'a faster preview covering the same field of view '
+                           'at a coarser sampling.')
+        form.addParam('doVolumes', params.BooleanParam, default=True,
+                      condition='psfEngine==%d' % PSF_PLUGIN,
+                      label='Write PSF volumes?',
+                      help='If No, the volumes are not written by the run '
+                           'and are not registered as outputs, so other '
+                           'protocols cannot use them. Only the viewer and '
+                           'the Python API (ProtCryoEF.getPsfVolume) can '
+                           'request them: they are generated from the '
+                           'stored orientation histogram the first time, '
+                           'at any box size, and kept for later requests.')
+
+        form.addSection(label='Micrographs')
+        form.addParam('doMicStats', params.BooleanParam, default=False,
+                      label='Per-micrograph statistics?',
+                      help='Score the orientation distribution of the '
+                           'particles of each micrograph (efficiency, mean '
+                           'PSF resolution and coverage) to find micrographs '
+                           'or areas of the grid with preferred orientation.')
+        form.addParam('inputMicrographs', params.PointerParam,
+                      pointerClass='SetOfMicrographs', allowsNull=True,
+                      condition='doMicStats',
+                      label='Input micrographs',
+                      help='Micrographs the particles were extracted from. '
+                           'A copy annotated with the scores of their '
+                           'particles is created.')
+        form.addParam('micSampling', params.FloatParam, default=15.0,
+                      condition='doMicStats',
                       expertLevel=params.LEVEL_ADVANCED,
-                      help='FSC resolution using 0.143 criterion. '
-                           'Default (-1) value means that resolution will be '
-                           'automatically estimated from B-factor.')
-        form.addParam('maxTilt', params.IntParam, default=45,
-                      label='Max tilt angle (deg)',
+                      label='Grid sampling (deg)',
+                      help='Angular size of the cells of the coarse sphere '
+                           'grid used to bin the particles of each '
+                           'micrograph.')
+        form.addParam('micRegions', params.IntParam, default=1,
+                      condition='doMicStats',
+                      label='Regions per micrograph side',
+                      help='Split each micrograph in NxN regions using the '
+                           'particle coordinates and score each region as '
+                           'well. The lowest region scores are added to the '
+                           'micrographs. Use 1 to score whole micrographs '
+                           'only.')
+        form.addParam('doAcqCurve', params.BooleanParam, default=False,
+                      label='Efficiency over acquisition?',
+                      help='Add the particles in acquisition order '
+                           '(micrograph id) and compute the efficiency and '
+                           'mean PSF resolution after each block of '
+                           'micrographs, to see how many micrographs are '
+                           'needed before the efficiency plateaus.')
+        form.addParam('acqBlocks', params.IntParam, default=20,
+                      condition='doAcqCurve',
+                      label='Number of curve points',
+                      help='The micrographs are added in this number of '
+                           'blocks of the same size.')
+        form.addParam('acqSampling', params.FloatParam, default=5.0,
+                      condition='doAcqCurve',
                       expertLevel=params.LEVEL_ADVANCED,
-                      help='Maximum tilt angle allowed for prediction '
-                           'algorithm, in degrees.')
+                      label='Curve sampling (deg)',
+                      help='Angular sampling of the directions where the PSF '
+                           'resolution is evaluated for each curve point.')
+
+        form.addSection(label='Weights')
+        form.addParam('doWeights', params.BooleanParam, default=False,
+                      label='Output weighted particles?',
+                      help='Output the input particles with a weight '
+                           '(_cryoef_weight) inversely proportional to the '
+                           'density of orientations around them, to '
+                           'compensate preferred views downstream.')
+        form.addParam('weightsMode', params.EnumParam,
+                      choices=['weights', 'flattened subset'],
+                      default=WEIGHTS_ALL, condition='doWeights',
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Output',
+                      help='*weights*: all particles with their weight.\n'
+                           '*flattened subset*: a deterministic subset with '
+                           'at most a maximum number of particles per '
+                           'orientation cell.')
+        form.addParam('weightsSampling', params.FloatParam, default=5.0,
+                      condition='doWeights',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Density sampling (deg)',
+                      help='Angular size of the sphere grid cells used to '
+                           'measure the orientation density.')
+        form.addParam('maxPerCell', params.IntParam, default=-1,
+                      condition='doWeights and weightsMode==%d'
+                                % WEIGHTS_SUBSET,
+                      label='Max particles per cell',
+                      help='Maximum number of particles kept in each '
+                           'orientation cell. Default (-1) uses the median '
+                           'number of particles of the occupied cells.')
+
+        form.addSection(label='Subsets')
+        form.addParam('doIndex', params.BooleanParam, default=False,
+                      label='Orientation index for subsets?',
+                      help='Store the orientation cell of every particle, '
+                           'so that the efficiency of any subset of the '
+                           'particles (selected classes, micrographs or '
+                           'particle ids) can be computed from the viewer '
+                           'or with ProtCryoEF.subsetEfficiency without a '
+                           'new run.')
+        form.addParam('indexSampling', params.FloatParam, default=5.0,
+                      condition='doIndex',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Index sampling (deg)',
+                      help='Angular size of the sphere grid cells of the '
+                           'index, which are also the directions where the '
+                           'PSF resolution of the subsets is evaluated.')
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     
     def _insertAllSteps(self):
         # Insert processing steps
         self._initialize()
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('runCryoEFStep')
-        self._insertFunctionStep('createOutputStep')
+        stepArgs = self._getStepArgs()
+        self._insertFunctionStep('convertInputStep',
+                                 *stepArgs['convertInputStep'])
+        if self.doWeights:
+            self._insertFunctionStep('weightParticlesStep',
+                                     *stepArgs['weightParticlesStep'])
+        if self.doIndex:
+            self._insertFunctionStep('indexParticlesStep',
+                                     *stepArgs['indexParticlesStep'])
+        if self.psfEngine == PSF_PLUGIN:
+            for step in ['computePSFStep', 'evaluatePSFStep',
+                         'computeVolumesStep']:
+                self._insertFunctionStep(step, *stepArgs[step])
+        else:
+            self._insertFunctionStep('runCryoEFStep',
+                                     *stepArgs['runCryoEFStep'])
+        if self.doMicStats:
+            self._insertFunctionStep('micrographStatsStep',
+                                     *stepArgs['micrographStatsStep'])
+        if self.doAcqCurve:
+            self._insertFunctionStep('acquisitionCurveStep',
+                                     *stepArgs['acquisitionCurveStep'])
+        self._insertFunctionStep('createOutputStep',
+                                 *stepArgs['createOutputStep'])
 
     # --------------------------- STEPS functions -----------------------------
     
-    def convertInputStep(self):
+    def convertInputStep(self, *inputArgs):
         """ Convert input angles as expected by cryoEF."""
-        partSet = self._getInputParticles()
-        anglesFn = self._getFileName('anglesFn')
-        with open(anglesFn, 'a') as f:
-            for part in partSet:
-                writeAnglesFn(part, f)
+        self._convertAngles(self._getInputParticles(),
+                            self._getFileName('anglesFn'),
+                            self._getFileName('anglesBin'))
 
-    def runCryoEFStep(self):
+    def runCryoEFStep(self, *args):
         """ Call cryoEF with the appropriate parameters. """
-        args = self._getArgs()
-        param = ' '.join(['%s %s' % (k, str(v)) for k, v in args.items()])
-        program = Plugin.getProgram()
+        self._runCryoEF(self._getArgs(),
+                        nParticles=self._getInputParticles().getSize())
 
-        self.runJob(program, param, env=Plugin.getEnviron())
+    def computePSFStep(self, *psfArgs):
+        """ Compute the geometric sums of the directions where the PSF
+        resolution is evaluated in Scipion. The sums do not depend on the
+        PSF model parameters, so they are stored to evaluate them later.
+        With adaptive sampling, the directions refined with the protocol
+        parameters are kept when they change. """
+        sampling = self.psfSampling.get()
+        histGrid = SphereGrid(sampling, hemisphere=True)
+        hist = angleHistogram(self.getAngles(mmap=True), histGrid,
+                              self.symmetryGroup.get(), self._getChunkSize())
+        np.save(self._getFileName('psf_hist'), hist)
+        model = self._getPSFModel()
+        chunkPairs = self._getChunkSize(self.BYTES_PER_PAIR)
+        sums = []
 
-    def createOutputStep(self):
-        partSet = self._getInputParticles()
+        if self.adaptiveSampling:
+            grid, _, rows, weights = adaptiveResolution(
+                model, hist, histGrid, sampling, self.psfTolerance.get(),
+                chunkPairs=chunkPairs, sums=sums)
+        else:
+            grid, _ = fixedResolution(model, hist, histGrid, sampling,
+                                      chunkPairs, sums)
+            rows = np.arange(grid.size)[:, None]
+            weights = np.ones(rows.shape)
+        sums = np.concatenate(sums)
+        self.info('PSF resolution evaluated along %d directions, the fixed '
+                  'grid has %d.' % (len(sums), grid.size))
+        np.savez(self._getFileName('psf_sums'), sums=sums, rows=rows,
+                 weights=weights, sampling=sampling)
+
+    def evaluatePSFStep(self, *args):
+        """ PSF resolution and statistics from the stored geometric sums,
+        the map of the resolution along each direction and the coverage
+        completeness of the resolution shells up to Nyquist. """
+        grid, res = self.evaluatePSF()
+        np.savetxt(self._getFileName('output_hist'), res, fmt='%0.4f')
+        ResolutionMap(grid, res).write(self._getFileName('res_map'))
+
+        boxSize = self._getArgs()['-b']
+        samplingRate = self._getInputParticles().getSamplingRate()
+        freqs = np.arange(1, boxSize // 2 + 1) / (boxSize * samplingRate)
+        threshold = self.coverageThreshold.get()
+        completeness = coverageCompleteness(
+            self._getPSFModel(), self._psfSums['sums'], freqs,
+            self._psfSums['rows'], threshold,
+            self._getChunkSize(self.BYTES_PER_PAIR),
+            self._psfSums.get('weights'))
+        np.savez(self._getFileName('coverage_curve'), freqs=freqs,
+                 completeness=completeness, threshold=threshold)
+        writeOutput(self._getFileName('output_log'),
+                    *PSFModel.statistics(res))
+
+    def computeVolumesStep(self, *args):
+        """ Generate the real and Fourier space PSF volumes in Scipion, or
+        leave them to be generated on demand. The volumes generated on
+        demand with previous PSF model parameters are removed. """
+        for fn in glob.glob(self._getExtraPath('psf_box*.mrc')):
+            os.remove(fn)
+        if self.doVolumes:
+            self._writeVolumes(self._getVolumeBoxSize(),
+                               self._getFileName('real space PSF'),
+                               self._getFileName('fourier space PSF'))
+        else:
+            self.info('PSF volumes will be generated when requested.')
+
+    def micrographStatsStep(self, *args):
+        """ Score the orientations of the particles of each micrograph,
+        and of each region of the micrographs, from grouped histograms. """
+        grid = SphereGrid(self.micSampling.get(), hemisphere=True)
+        model = self._getPSFModel(nFreq=self.MIC_FREQUENCIES)
+        symmetryGroup = self.symmetryGroup.get()
+        keys = ['Ids', 'Particles', 'Efficiency', 'MeanRes', 'Coverage']
+        tiles = self.micRegions.get()
+        micHists = GroupHistograms(grid.size)
+        regionHists = GroupHistograms(grid.size) if tiles > 1 else None
+        micSize = self._getMicrographSize() if tiles > 1 else None
+        if tiles > 1 and micSize is None:
+            self.info('Particles have no coordinates, region statistics '
+                      'are skipped.')
+            regionHists = None
+
+        labels = [COORD_X_LABEL, COORD_Y_LABEL] if regionHists else []
+        for columns, cells in zip(self._iterParticleColumns(*labels),
+                                  self._iterCells(grid)):
+            micIds = columns[MIC_ID_LABEL]
+            micHists.add(micIds, cells)
+            if regionHists is not None:
+                tileX = np.clip(columns[COORD_X_LABEL] * tiles // micSize[0],
+                                0, tiles - 1)
+                tileY = np.clip(columns[COORD_Y_LABEL] * tiles // micSize[1],
+                                0, tiles - 1)
+                regionHists.add(micIds * tiles ** 2 +
+                                (tileY * tiles + tileX).astype(np.int64),
+                                cells)
+
+        results = dict(zip(['mic' + k for k in keys],
+                           histogramScores(*micHists.histograms(), grid,
+                                           model, symmetryGroup)))
+        self.info('Scored the particles of %d micrographs.'
+                  % len(results['micIds']))
+
+        if regionHists is not None:
+            results.update(zip(['region' + k for k in keys],
+                               histogramScores(*regionHists.histograms(),
+                                               grid, model, symmetryGroup)))
+            # lowest region scores of each micrograph
+            micIndex = np.searchsorted(results['micIds'],
+                                       results['regionIds'] // tiles ** 2)
+            for key in ['Efficiency', 'Coverage']:
+                lowest = np.full(len(results['micIds']), np.nan)
+                np.fmin.at(lowest, micIndex, results['region' + key])
+                results['micMinRegion' + key] = lowest
+
+        np.savez(self._getFileName('mic_stats'), tiles=tiles, **results)
+
+    def acquisitionCurveStep(self, *args):
+        """ Efficiency and mean PSF resolution as the particles of
+        successive blocks of micrographs are added to the distribution.
+        The histograms of the micrographs are accumulated one chunk of
+        particles at a time, and summed per block of micrographs. """
+        grid = SphereGrid(self.acqSampling.get(), hemisphere=True)
+        micHists = GroupHistograms(grid.size)
+        for columns, cells in zip(self._iterParticleColumns(),
+                                  self._iterCells(grid)):
+            micHists.add(columns[MIC_ID_LABEL], cells)
+
+        _, micParticles = micHists.labels()
+        nMics = len(micParticles)
+        micrographs = np.unique(np.linspace(
+            0, nMics, self.acqBlocks.get() + 1).round().astype(np.int64))[1:]
+        # block of each micrograph, in micrograph id order
+        blocks = np.searchsorted(micrographs, np.arange(nMics), side='right')
+        particles = np.cumsum(micParticles)[micrographs - 1]
+
+        accumulator = OrientationAccumulator(grid, grid.directions,
+                                             self.symmetryGroup.get())
+        model = self._getPSFModel()
+        efficiency = np.zeros(len(particles))
+        meanRes = np.zeros(len(particles))
+        for i, hist in enumerate(micHists.histograms(blocks)):
+            accumulator.addHistogram(hist)
+            efficiency[i], meanRes[i] = model.statistics(
+                model.resolution(accumulator.sums))[:2]
+            self.info('%d micrographs, %d particles: efficiency %0.3f, '
+                      'mean PSF resolution %0.2f A'
+                      % (micrographs[i], particles[i], efficiency[i],
+                         meanRes[i]))
+
+        np.savez(self._getFileName('acq_curve'), micrographs=micrographs,
+                 particles=particles, efficiency=efficiency, meanRes=meanRes)
+
+    def weightParticlesStep(self, *args):
+        """ Write the output particles with inverse density weights, or
+        the flattened subset, as a copy of the input set sqlite updated
+        with bulk statements. """
+        dbName = self._getFileName('weighted_particles')
+        shutil.copyfile(self._getInputParticles().getFileName(), dbName)
+        grid = SphereGrid(self.weightsSampling.get(), hemisphere=True)
+        counts = angleHistogram(self.getAngles(mmap=True), grid,
+                                chunkSize=self._getChunkSize())
+
+        if self.weightsMode == WEIGHTS_ALL:
+            hist = expandHistogram(counts, grid, self.symmetryGroup.get())
+            chunks = ((ids, inverseDensityWeights(cells, hist, counts))
+                      for ids, cells in self._iterCells(grid, withIds=True))
+            addSetColumn(dbName, '_cryoef_weight', 'Float', chunks)
+            weights = inverseDensityWeights(np.flatnonzero(counts), hist,
+                                            counts)
+            self.info('Particle weights range from %0.3f to %0.3f.'
+                      % (weights.min(), weights.max()))
+        else:
+            maxPerCell = self.maxPerCell.get()
+            if maxPerCell <= 0:
+                maxPerCell = int(np.median(counts[counts > 0]))
+
+            def _keyChunks():
+                for ids, cells in self._iterCells(grid, withIds=True):
+                    yield hashIds(ids), cells
+
+            thresholds = flattenThresholds(_keyChunks, grid.size, maxPerCell)
+            deleteSetItems(dbName, (
+                ids[hashIds(ids) > thresholds[cells]]
+                for ids, cells in self._iterCells(grid, withIds=True)))
+            self.info('Kept %d of %d particles, at most %d per cell.'
+                      % (np.minimum(counts, maxPerCell).sum(), counts.sum(),
+                         maxPerCell))
+
+    def indexParticlesStep(self, *args):
+        """ Write the orientation index: the ids of the input particles
+        and their orientation cell, as memory-mappable arrays. """
+        grid = SphereGrid(self.indexSampling.get(), hemisphere=True)
+        writeOrientationIndex(self._iterCells(grid, withIds=True),
+                              self._getInputParticles().getSize(),
+                              self._getFileName('index_ids'),
+                              self._getFileName('index_cells'))
+
+    def createOutputStep(self, *args):
+        sampling = self._getVolumeSamplingRate()
 
         vol = Volume()
-        vol.setSamplingRate(partSet.getSamplingRate())
+        vol.setSamplingRate(sampling)
         vol.setObjLabel('real space PSF')
         vol.setFileName(self._getFileName('real space PSF'))
 
         vol2 = Volume()
-        vol2.setSamplingRate(partSet.getSamplingRate())
+        vol2.setSamplingRate(sampling)
         vol2.setObjLabel('fourier space PSF')
         vol2.setFileName(self._getFileName('fourier space PSF'))
 
-        outputs = {'outputVolume1': vol,
-                   'outputVolume2': vol2}
-        self._defineOutputs(**outputs)
-        self._defineSourceRelation(self.inputParticles, vol)
-        self._defineSourceRelation(self.inputParticles, vol2)
+        if self.psfEngine != PSF_PLUGIN or self.doVolumes:
+            outputs = {'outputVolume1': vol,
+                       'outputVolume2': vol2}
+            self._defineOutputs(**outputs)
+            self._defineSourceRelation(self.inputParticles, vol)
+            self._defineSourceRelation(self.inputParticles, vol2)
+
+        if self.doMicStats:
+            self._createMicrographsOutput()
+        if self.doWeights:
+            self._createParticlesOutput()
 
     # --------------------------- INFO functions ------------------------------
     
     def _summary(self):
         summary = []
 
-        if hasattr(self, 'outputVolume1'):
-            results = list(parseOutput(self._getExtraPath('input_angles.log')))
+        results = list(parseOutput(self._getExtraPath('input_angles.log')))
+        if self.isFinished() and len(results) == 5:
             eff, meanRes, stdev, worstRes, bestRes = results
             summary.append('Efficiency of the orientation distribution: *%0.2f*' % eff)
             summary.append('Mean PSF resolution: *%0.2f A*' % meanRes)
             summary.append('Standard deviation: *%0.2f A*' % stdev)
             summary.append('Worst PSF resolution: *%0.2f A*' % worstRes)
             summary.append('Best PSF resolution: *%0.2f A*' % bestRes)
+            summary.extend(self._getMicrographsSummary())
+            summary.extend(self._getCoverageSummary())
+            summary.extend(self._getAcquisitionSummary())
         else:
             summary.append("Output is not ready yet.")
+            summary.extend(self._getProgressSummary())
 
         return summary
     
+    def _warnings(self):
+        warnings = []
+        if self.psfEngine == PSF_PLUGIN and self.doVolumes:
+            boxSize = self.psfBoxSize.get()
+            if boxSize <= 0 and self.inputParticles.hasValue():
+                boxSize = self._getInputParticles().getXDim() or 0
+            needed = boxSize ** 3 * self.BYTES_PER_VOXEL / 2 ** 20
+            if needed > self.memoryBudget.get():
+                warnings.append('The PSF volumes need about %d MB, more than '
+                                'the memory budget. Reduce the PSF volumes '
+                                'box size to stay within it.' % needed)
+        return warnings
+
     def _validate(self):
         errors = []
+        if self.psfEngine == PSF_PLUGIN:
+            if self.psfSampling.get() <= 0:
+                errors.append('Direction sampling should be positive.')
+            if 0 < self.psfBoxSize.get() < 16:
+                errors.append('PSF volumes box size should be at least 16 px.')
+        if self.doAcqCurve and (self.acqBlocks.get() < 1 or
+                                self.acqSampling.get() <= 0):
+            errors.append('The efficiency over acquisition needs at least one '
+                          'curve point and a positive sampling.')
+        if self.doIndex and self.indexSampling.get() < 2:
+            errors.append('Index sampling should be at least 2 deg.')
+        if self.doWeights and self.weightsSampling.get() <= 0:
+            errors.append('Density sampling should be positive.')
+        if self.doMicStats:
+            if not self.inputMicrographs.hasValue():
+                errors.append('Input micrographs are required for '
+                              'per-micrograph statistics.')
+            if self.micSampling.get() <= 0:
+                errors.append('Grid sampling should be positive.')
+            if self.micRegions.get() < 1:
+                errors.append('Regions per micrograph side should be at '
+                              'least 1.')
 
         return errors
     
@@ -178,18 +816,328 @@ class ProtCryoEF(ProtAnalysis3D):
  
     def _getArgs(self):
         """ Prepare the args dictionary."""
-        args = {'-f': self._getFileName('anglesFn'),
-                '-b': self._getInputParticles().getFirstItem().getXDim(),
-                '-a': self.angAcc.get(),
-                '-B': self.Bfact.get(),
-                '-D': self.diam.get(),
-                '-g': self.symmetryGroup.get() or 'c1',
-                '-m': self.maxTilt.get()
-                }
-        if self.FSCres.get() != -1:
-            args['-r'] = self.FSCres.get()
-
-        return args
+        return self._getCryoEFArgs(
+            self._getFileName('anglesFn'),
+            self._getInputParticles().getFirstItem().getXDim())
 
     def _getInputParticles(self):
         return self.inputParticles.get()
+
+    def _getVolumeBoxSize(self):
+        """ Box size of the PSF volumes. """
+        boxSize = self._getInputParticles().getFirstItem().getXDim()
+        if self.psfEngine == PSF_PLUGIN and self.psfBoxSize.get() > 0:
+            boxSize = self.psfBoxSize.get()
+        return boxSize
+
+    def _getVolumeSamplingRate(self, boxSize=None):
+        """ Pixel size of the PSF volumes, which keep the field of view
+        of the particle box. """
+        partSet = self._getInputParticles()
+        partBox = partSet.getFirstItem().getXDim()
+        return (partSet.getSamplingRate() * partBox /
+                (boxSize or self._getVolumeBoxSize()))
+
+    def _getPSFHistogram(self):
+        """ Orientation histogram of the plugin PSF engine, computed from
+        the converted angles and stored if the run did not do it. """
+        grid = SphereGrid(self.psfSampling.get(), hemisphere=True)
+        histFn = self._getFileName('psf_hist')
+        if os.path.exists(histFn):
+            return grid, np.load(histFn)
+        hist = angleHistogram(self.getAngles(mmap=True), grid,
+                              self.symmetryGroup.get(), self._getChunkSize())
+        np.save(histFn, hist)
+        return grid, hist
+
+    def _writeVolumes(self, boxSize, realFn, fourierFn):
+        """ Write the real and Fourier space PSF volumes of a box size. """
+        import mrcfile
+
+        grid, hist = self._getPSFHistogram()
+        sampling = self._getVolumeSamplingRate(boxSize)
+        volumes = psfVolumes(hist, grid, boxSize, sampling,
+                             self._getPSFModel(),
+                             threads=self.numberOfThreads.get())
+
+        for fn, data in zip([realFn, fourierFn], volumes):
+            with mrcfile.new(fn, overwrite=True) as mrc:
+                mrc.set_data(data)
+                mrc.voxel_size = sampling
+
+    def _getInputArgs(self):
+        """ Identify the input particles in the step arguments: their set
+        id and size. """
+        partSet = self._getInputParticles()
+        return [partSet.getObjId(), partSet.getSize()]
+
+    def _getStepArgs(self):
+        """ Arguments of each step: the input sets and every parameter the
+        step reads. Continuing the protocol only compares the step names
+        and arguments, so a step reruns exactly when one of them changed.
+        When only the PSF model parameters change, the converted angles
+        and the geometric sums are kept.
+        """
+        inputArgs = self._getInputArgs()
+        modelArgs = self._getPSFModelArgs()
+        symmetryGroup = self.symmetryGroup.get()
+        psfArgs = inputArgs + [symmetryGroup, self.psfSampling.get(),
+                               self.adaptiveSampling.get(),
+                               self.psfTolerance.get()]
+        volumeArgs = [self.doVolumes.get(), self.psfBoxSize.get()]
+        micArgs = []
+        if self.doMicStats:
+            mics = self.inputMicrographs.get()
+            micArgs = [mics.getObjId(), mics.getSize(),
+                       self.micSampling.get(), self.micRegions.get()]
+        weightArgs = [self.weightsMode.get(), self.weightsSampling.get(),
+                      self.maxPerCell.get()] if self.doWeights else []
+
+        return {
+            'convertInputStep': inputArgs,
+            'weightParticlesStep': inputArgs + [symmetryGroup] + weightArgs,
+            'indexParticlesStep': inputArgs + [symmetryGroup,
+                                               self.indexSampling.get()],
+            'runCryoEFStep': inputArgs + modelArgs + [symmetryGroup,
+                                                      self.maxTilt.get()],
+            'computePSFStep': psfArgs,
+            'evaluatePSFStep': psfArgs + modelArgs + [
+                self.coverageThreshold.get()],
+            'computeVolumesStep': psfArgs + modelArgs + volumeArgs,
+            'micrographStatsStep': inputArgs + modelArgs + [symmetryGroup] +
+            micArgs,
+            'acquisitionCurveStep': inputArgs + modelArgs + [
+                symmetryGroup, self.acqBlocks.get(), self.acqSampling.get()],
+            'createOutputStep': psfArgs + modelArgs + volumeArgs + [
+                self.psfEngine.get(), self.maxTilt.get(),
+                self.doMicStats.get(), self.doWeights.get()] + micArgs +
+            weightArgs
+        }
+
+    def _getPSFModelArgs(self):
+        return [self.Bfact.get(), self.diam.get(), self.angAcc.get(),
+                self.FSCres.get()]
+
+    def _getPSFModel(self, **kwargs):
+        """ PSF model of the protocol parameters, overridden by the
+        keyword arguments of PSFModel given. """
+        modelArgs = dict(zip(['bfactor', 'diameter', 'angAcc', 'fscRes'],
+                             self._getPSFModelArgs()))
+        modelArgs.update(kwargs)
+        return PSFModel(**modelArgs)
+
+    def _iterCells(self, grid, withIds=False):
+        """ Yield the grid cell of the input particles, and their ids if
+        withIds, one chunk of particles at a time. """
+        chunkSize = self._getChunkSize()
+        chunks = self.getAngles(mmap=True).iterChunks(chunkSize)
+        if not withIds:
+            for angles in chunks:
+                yield grid.getIndex(angles.to_vectors())
+            return
+        dbName = self._getInputParticles().getFileName()
+        for columns, angles in zip(iterSetColumns(dbName, [], chunkSize),
+                                   chunks):
+            yield columns['id'], grid.getIndex(angles.to_vectors())
+
+    def _iterParticleColumns(self, *labels):
+        """ Yield the micrograph ids, and other attribute columns, of the
+        input particles in id order, one chunk of particles at a time and
+        as numpy arrays (None for the labels the particles do not have). """
+        for columns in iterSetColumns(self._getInputParticles().getFileName(),
+                                      [MIC_ID_LABEL] + list(labels),
+                                      self._getChunkSize()):
+            if columns[MIC_ID_LABEL] is None:
+                raise Exception('The input particles have no micrograph ids.')
+            columns[MIC_ID_LABEL] = np.array(columns[MIC_ID_LABEL],
+                                             dtype=np.int64)
+            for label in labels:
+                if columns[label] is not None:
+                    columns[label] = np.array(columns[label],
+                                              dtype=np.float64)
+            yield columns
+
+    def _getMicrographSize(self):
+        """ Micrograph dimensions, or the extent of the particle
+        coordinates if they are unknown. None if the particles have
+        no coordinates. """
+        labels = [COORD_X_LABEL, COORD_Y_LABEL]
+        dim = self.inputMicrographs.get().getDim()
+        size = None
+        for columns in iterSetColumns(self._getInputParticles().getFileName(),
+                                      labels, self._getChunkSize()):
+            if any(columns[label] is None for label in labels):
+                return None
+            if dim and dim[0] and dim[1]:
+                return dim[0], dim[1]
+            extent = [max(columns[label]) + 1 for label in labels]
+            size = extent if size is None else np.maximum(size, extent)
+        return None if size is None else tuple(size)
+
+    def _createMicrographsOutput(self):
+        """ Copy the input micrographs adding the scores of their
+        particles as extra attributes. """
+        # Read every array once, the lazy npz file would decompress them
+        # again on each lookup
+        with np.load(self._getFileName('mic_stats')) as data:
+            stats = {key: data[key] for key in data.files}
+        self._micIndex = {micId: i for i, micId
+                          in enumerate(stats['micIds'].tolist())}
+        self._micStats = stats
+        inputMics = self.inputMicrographs.get()
+        micSet = self._createSetOfMicrographs()
+        micSet.copyInfo(inputMics)
+        micSet.copyItems(inputMics, updateItemCallback=self._updateMicrograph)
+        del self._micStats, self._micIndex
+
+        self._defineOutputs(outputMicrographs=micSet)
+        self._defineSourceRelation(self.inputParticles, micSet)
+        self._defineSourceRelation(self.inputMicrographs, micSet)
+
+    def _createParticlesOutput(self):
+        """ Register the particles written by weightParticlesStep. """
+        partSet = SetOfParticles(filename=self._getFileName('weighted_particles'))
+        partSet.copyInfo(self._getInputParticles())
+        partSet.write()
+
+        self._defineOutputs(outputParticles=partSet)
+        self._defineSourceRelation(self.inputParticles, partSet)
+
+    def _updateMicrograph(self, mic, row):
+        i = self._micIndex.get(mic.getObjId())
+        stats = self._micStats
+        mic._cryoef_particles = Integer(0 if i is None
+                                        else stats['micParticles'][i])
+        for attr, key in [('efficiency', 'micEfficiency'),
+                          ('meanRes', 'micMeanRes'),
+                          ('coverage', 'micCoverage'),
+                          ('minRegionEfficiency', 'micMinRegionEfficiency'),
+                          ('minRegionCoverage', 'micMinRegionCoverage')]:
+            if key in stats:
+                value = None if i is None else stats[key][i]
+                setattr(mic, '_cryoef_' + attr,
+                        Float(None if value is None or np.isnan(value)
+                              else float(value)))
+
+    def _getMicrographsSummary(self):
+        self._initialize()
+        statsFn = self._getFileName('mic_stats')
+        if not self.doMicStats or not os.path.exists(statsFn):
+            return []
+        stats = np.load(statsFn)
+        efficiency = stats['micEfficiency']
+        return ['Micrographs scored: %d, median efficiency *%0.2f*, '
+                'lowest %0.2f' % (len(efficiency), np.nanmedian(efficiency),
+                                  np.nanmin(efficiency))]
+
+    def _getCoverageSummary(self):
+        self._initialize()
+        curveFn = self._getFileName('coverage_curve')
+        if not os.path.exists(curveFn):
+            return []
+        curve = np.load(curveFn)
+        incomplete = np.flatnonzero(curve['completeness'] < 0.9)
+        if not len(incomplete):
+            return ['Fourier coverage is at least 90%% complete up to '
+                    'Nyquist (%0.2f A)' % (1 / curve['freqs'][-1])]
+        return ['Fourier coverage completeness drops below 90%% at '
+                '*%0.2f A*' % (1 / curve['freqs'][incomplete[0]])]
+
+    def _getAcquisitionSummary(self):
+        self._initialize()
+        curveFn = self._getFileName('acq_curve')
+        if not self.doAcqCurve or not os.path.exists(curveFn):
+            return []
+        curve = np.load(curveFn)
+        efficiency = curve['efficiency']
+        plateau = np.flatnonzero(efficiency >= 0.95 * efficiency[-1])[0]
+        return ['Efficiency reaches 95%% of its final value after *%d* of '
+                '%d micrographs (%d particles)'
+                % (curve['micrographs'][plateau], curve['micrographs'][-1],
+                   curve['particles'][plateau])]
+
+    def evaluatePSF(self, **kwargs):
+        """ Evaluate the PSF resolution along the directions of the plugin
+        PSF engine from its stored geometric sums, which takes a fraction
+        of a second. Keyword arguments (bfactor, diameter, angAcc, fscRes)
+        override the PSF model parameters of the protocol.
+
+        Returns the hemisphere grid and the resolution of every cell.
+        """
+        if self._psfSums is None:
+            with np.load(self._getFileName('psf_sums')) as data:
+                self._psfSums = dict(data)
+        model = self._getPSFModel(**kwargs)
+        grid = SphereGrid(float(self._psfSums['sampling']), hemisphere=True)
+        res = sumsResolution(model, self._psfSums['sums'],
+                             self._psfSums['rows'],
+                             self._getChunkSize(self.BYTES_PER_PAIR),
+                             self._psfSums.get('weights'))
+        return grid, res
+
+    def getResolutionMap(self):
+        """ Return the ResolutionMap of the plugin PSF engine, to look up
+        the PSF resolution along any direction. """
+        return ResolutionMap.load(self._getFileName('res_map'))
+
+    def getPsfVolume(self, kind=VOL_RS_PSF, boxSize=None, generate=True):
+        """ Return the file of the real (VOL_RS_PSF) or Fourier space
+        (VOL_FS_PSF) PSF volume, covering the field of view of the
+        particles with a box of boxSize (default, the box of the run).
+
+        The volumes written by the run are returned as they are. Other
+        volumes are generated from the orientation histogram the first
+        time they are requested and kept in the extra folder. If not
+        generate, None is returned for the volumes not generated yet.
+        """
+        if not boxSize or boxSize <= 0:
+            boxSize = self._getVolumeBoxSize()
+        key = 'real space PSF' if kind == VOL_RS_PSF else 'fourier space PSF'
+        if boxSize == self._getVolumeBoxSize() and \
+                os.path.exists(self._getFileName(key)):
+            return self._getFileName(key)
+        realFn = self._getFileName('psf_volume', box=boxSize, kind='R')
+        fourierFn = self._getFileName('psf_volume', box=boxSize, kind='K')
+        if not (os.path.exists(realFn) and os.path.exists(fourierFn)):
+            if not generate:
+                return None
+            self._writeVolumes(boxSize, realFn, fourierFn)
+        return realFn if kind == VOL_RS_PSF else fourierFn
+
+    def getOrientationIndex(self):
+        """ Return the OrientationIndex of the input particles, with the
+        index arrays memory-mapped. """
+        if self._orientationIndex is None:
+            self._orientationIndex = OrientationIndex(
+                np.load(self._getFileName('index_ids'), mmap_mode='r'),
+                np.load(self._getFileName('index_cells'), mmap_mode='r'),
+                SphereGrid(self.indexSampling.get(), hemisphere=True),
+                self.symmetryGroup.get(),
+                self._getChunkSize(self.BYTES_PER_PAIR))
+        return self._orientationIndex
+
+    def subsetEfficiency(self, ids, **kwargs):
+        """ Score a subset of the input particles with the orientation
+        index, without converting the particles again. ids is an iterable
+        of particle ids, a SetOfParticles (e.g. a Class2D) or a
+        SetOfClasses (the particles of its enabled classes). Keyword
+        arguments override the PSF model parameters (see evaluatePSF).
+
+        Returns the number of particles of the subset found in the index
+        and the PSF statistics: efficiency, mean, standard deviation, worst
+        and best resolution.
+        """
+        if isinstance(ids, SetOfClasses):
+            ids = [part.getObjId() for part in ids.iterClassItems()]
+        elif isinstance(ids, SetOfParticles):
+            ids = [part.getObjId() for part in ids]
+        return self.getOrientationIndex().score(self._getPSFModel(**kwargs),
+                                                ids)
+
+    def getAngles(self, mmap=False):
+        """ Return the AngleSet of the converted input particles. """
+        binFn = self._getFileName('anglesBin')
+        if os.path.exists(binFn):
+            return AngleSet.load(binFn, mmap=mmap)
+        # runs converted before the binary file was written
+        return AngleSet.read(self._getFileName('anglesFn'))
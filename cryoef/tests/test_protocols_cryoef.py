@@ -25,12 +25,25 @@
 # **************************************************************************
 
 import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
 
 from pyworkflow.utils import magentaStr
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
-from pwem.protocols import ProtImportParticles
+from pwem.objects import SetOfClasses2D, Class2D
+from pwem.protocols import ProtImportParticles, ProtImportMicrographs
 
-from ..protocols import ProtCryoEF
+from ..protocols import ProtCryoEF, ProtCryoEFCompare
+from ..constants import PSF_PLUGIN, VOL_FS_PSF
+from ..convert import (parseOutput, parseProgress, AngleSet, SphereGrid,
+                       geometryFromMatrix)
+from ..analysis import (PSFModel, angleHistogram, fixedResolution,
+                        adaptiveResolution, sumsResolution, GroupHistograms,
+                        OrientationAccumulator, estimateDiameter)
 
 
 class TestCryoEFBase(BaseTest):
@@ -38,6 +51,7 @@ class TestCryoEFBase(BaseTest):
     def setData(cls, dataProject='relion_tutorial'):
         cls.ds = DataSet.getDataSet(dataProject)
         cls.partFn = cls.ds.getFile('import/refine3d/extra/relion_it025_data.star')
+        cls.micsFn = cls.ds.getFile('allMics')
 
     @classmethod
     def runImportParticlesStar(cls, partStar, mag, samplingRate):
@@ -51,6 +65,15 @@ class TestCryoEFBase(BaseTest):
         cls.launchProtocol(protImport)
         return protImport
 
+    @classmethod
+    def runImportMicrographs(cls, micsFn, samplingRate):
+        """ Import micrographs. """
+        protImport = cls.newProtocol(ProtImportMicrographs,
+                                     filesPath=micsFn,
+                                     samplingRate=samplingRate)
+        cls.launchProtocol(protImport)
+        return protImport
+
 
 class TestCryoEF(TestCryoEFBase):
     @classmethod
@@ -69,3 +92,415 @@ class TestCryoEF(TestCryoEFBase):
         protFsc._initialize()
         self.assertTrue(os.path.exists(protFsc._getFileName('real space PSF')),
                         "cryoEF has failed")
+
+    def test_cryoEFPlugin(self):
+        print(magentaStr("\n==> Testing cryoEF - plugin PSF:"))
+        protPsf = self.newProtocol(ProtCryoEF,
+                                   inputParticles=self.protImportParts.outputParticles,
+                                   diam=300, psfEngine=PSF_PLUGIN)
+        self.launchProtocol(protPsf)
+        protPsf._initialize()
+        results = list(parseOutput(protPsf._getFileName('output_log')))
+        self.assertEqual(len(results), 5, "PSF computation has failed")
+        self.assertTrue(0 < results[0] <= 1)
+        # re-evaluation from the stored geometric sums
+        grid, res = protPsf.evaluatePSF()
+        self.assertAlmostEqual(res.mean(), results[1], places=2)
+        grid, res = protPsf.evaluatePSF(bfactor=400)
+        self.assertEqual(len(res), grid.size)
+        self.assertGreater(res.mean(), results[1])
+        # directional resolution map
+        resMap = protPsf.getResolutionMap()
+        values = resMap.lookup([0, 90, 180], [0, 45, 180])
+        self.assertEqual(values.dtype, np.float32)
+        self.assertAlmostEqual(values[0], values[2], places=4)
+        # coverage completeness up to Nyquist
+        curve = np.load(protPsf._getFileName('coverage_curve'))
+        self.assertAlmostEqual(curve['freqs'][-1], 1 / (2 * 7.08), places=4)
+        self.assertTrue(np.all((curve['completeness'] >= 0) &
+                               (curve['completeness'] <= 1)))
+
+    def test_cryoEFLazyVolumes(self):
+        print(magentaStr("\n==> Testing cryoEF - volumes on demand:"))
+        protLazy = self.newProtocol(ProtCryoEF,
+                                    inputParticles=self.protImportParts.outputParticles,
+                                    diam=300, psfEngine=PSF_PLUGIN,
+                                    doVolumes=False)
+        self.launchProtocol(protLazy)
+        protLazy._initialize()
+        self.assertFalse(hasattr(protLazy, 'outputVolume1'))
+        volFn = protLazy.getPsfVolume(VOL_FS_PSF, boxSize=32)
+        self.assertTrue(os.path.exists(volFn), "Volume generation has failed")
+        self.assertEqual(protLazy.getPsfVolume(VOL_FS_PSF, boxSize=32), volFn)
+
+    def test_cryoEFCompare(self):
+        print(magentaStr("\n==> Testing cryoEF - compare orientations:"))
+        parts = self.protImportParts.outputParticles
+        protCompare = self.newProtocol(ProtCryoEFCompare,
+                                       inputSets=[parts, parts],
+                                       diam=300)
+        self.launchProtocol(protCompare)
+        protCompare._initialize()
+        self.assertTrue(os.path.exists(protCompare._getFileName('comparison')),
+                        "cryoEF comparison has failed")
+        self.assertSetSize(protCompare.outputVolumes, 1)
+
+    def test_cryoEFMicrographs(self):
+        print(magentaStr("\n==> Testing cryoEF - per-micrograph statistics:"))
+        protImportMics = self.runImportMicrographs(self.micsFn, 3.54)
+        protMics = self.newProtocol(ProtCryoEF,
+                                    inputParticles=self.protImportParts.outputParticles,
+                                    inputMicrographs=protImportMics.outputMicrographs,
+                                    diam=300, psfEngine=PSF_PLUGIN,
+                                    doMicStats=True, micRegions=2,
+                                    doAcqCurve=True, acqBlocks=5)
+        self.launchProtocol(protMics)
+        protMics._initialize()
+        self.assertSetSize(protMics.outputMicrographs,
+                           protImportMics.outputMicrographs.getSize())
+        self.assertTrue(os.path.exists(protMics._getFileName('acq_curve')),
+                        "Efficiency over acquisition has failed")
+
+    def test_cryoEFStepArgs(self):
+        print(magentaStr("\n==> Testing cryoEF - step arguments:"))
+        mics = self.runImportMicrographs(self.micsFn, 3.54).outputMicrographs
+        otherMics = self.runImportMicrographs(self.micsFn,
+                                              3.54).outputMicrographs
+        base = dict(inputParticles=self.protImportParts.outputParticles,
+                    inputMicrographs=mics, diam=300, psfEngine=PSF_PLUGIN,
+                    doMicStats=True, doAcqCurve=True)
+
+        def stepArgs(**kwargs):
+            prot = self.newProtocol(ProtCryoEF, **dict(base, **kwargs))
+            prot._insertAllSteps()
+            return {step.funcName.get(): step.argsStr.get()
+                    for step in prot._steps}
+
+        reference = stepArgs()
+        volumeSteps = ['computeVolumesStep', 'createOutputStep']
+        micSteps = ['micrographStatsStep', 'createOutputStep']
+        # continuing the protocol reruns a step only if its arguments change
+        for kwargs, steps in [
+                (dict(symmetryGroup='c2'),
+                 ['computePSFStep', 'evaluatePSFStep', 'micrographStatsStep',
+                  'acquisitionCurveStep']),
+                (dict(psfSampling=3.0), ['computePSFStep', 'evaluatePSFStep']),
+                (dict(coverageThreshold=0.3), ['evaluatePSFStep']),
+                (dict(Bfact=100), ['evaluatePSFStep', 'computeVolumesStep',
+                                   'micrographStatsStep']),
+                (dict(psfBoxSize=64), volumeSteps),
+                (dict(doVolumes=False), volumeSteps),
+                (dict(micSampling=10.0), micSteps),
+                (dict(micRegions=2), micSteps),
+                (dict(inputMicrographs=otherMics), micSteps),
+                (dict(acqBlocks=5), ['acquisitionCurveStep']),
+                (dict(acqSampling=10.0), ['acquisitionCurveStep'])]:
+            changed = stepArgs(**kwargs)
+            for step in steps:
+                self.assertNotEqual(changed[step], reference[step],
+                                    '%s ignores %s' % (step, kwargs))
+            self.assertEqual(changed['convertInputStep'],
+                             reference['convertInputStep'])
+        # the geometric sums are kept when only the PSF model changes
+        self.assertEqual(stepArgs(Bfact=100)['computePSFStep'],
+                         reference['computePSFStep'])
+
+    def test_cryoEFWeights(self):
+        print(magentaStr("\n==> Testing cryoEF - weighted particles:"))
+        parts = self.protImportParts.outputParticles
+        protWeights = self.newProtocol(ProtCryoEF, inputParticles=parts,
+                                       diam=300, psfEngine=PSF_PLUGIN,
+                                       doWeights=True)
+        self.launchProtocol(protWeights)
+        self.assertSetSize(protWeights.outputParticles, parts.getSize())
+        self.assertTrue(hasattr(protWeights.outputParticles.getFirstItem(),
+                                '_cryoef_weight'))
+
+    def test_cryoEFSubsets(self):
+        print(magentaStr("\n==> Testing cryoEF - subset efficiency:"))
+        parts = self.protImportParts.outputParticles
+        protIndex = self.newProtocol(ProtCryoEF, inputParticles=parts,
+                                     diam=300, psfEngine=PSF_PLUGIN,
+                                     doIndex=True)
+        self.launchProtocol(protIndex)
+        protIndex._initialize()
+        ids = [part.getObjId() for part in parts][::2]
+        count, stats = protIndex.subsetEfficiency(ids)
+        self.assertEqual(count, len(ids))
+        self.assertTrue(0 < stats[0] <= 1)
+        count, _ = protIndex.subsetEfficiency(parts)
+        self.assertEqual(count, parts.getSize())
+        # classes score their particles, not the class ids
+        classes = SetOfClasses2D(
+            filename=self.proj.getTmpPath('cryoef_classes2D.sqlite'))
+        classes.setImages(parts)
+        for classId in [1, 2]:
+            class2D = Class2D(objId=classId)
+            class2D.copyInfo(parts)
+            classes.append(class2D)
+            for part in parts:
+                if part.getObjId() % 2 == classId % 2:
+                    class2D.append(part.clone())
+            classes.update(class2D)
+        classes.write()
+        count, _ = protIndex.subsetEfficiency(classes)
+        self.assertEqual(count, parts.getSize())
+        oddIds = [part.getObjId() for part in parts if part.getObjId() % 2]
+        count, stats = protIndex.subsetEfficiency(classes[1])
+        oddCount, oddStats = protIndex.subsetEfficiency(oddIds)
+        self.assertEqual(count, oddCount)
+        self.assertAlmostEqual(stats[0], oddStats[0], places=6)
+
+
+# Converts the angles of a particles sqlite and runs the plugin PSF engine
+# with the given chunk sizes, then prints the peak resident memory (MB)
+# reached on top of the memory used after the imports.
+MEMORY_SCRIPT = """
+import os, resource, sys
+from cryoef.convert import AngleSet, SphereGrid, countSetItems, writeAngleFiles
+from cryoef.analysis import PSFModel, angleHistogram, fixedResolution
+
+dbName, outDir = sys.argv[1:3]
+chunkSize, chunkPairs = map(int, sys.argv[3:5])
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+angles = writeAngleFiles(AngleSet.iterSqlite(dbName, chunkSize),
+                         countSetItems(dbName),
+                         os.path.join(outDir, 'input_angles.dat'),
+                         os.path.join(outDir, 'input_angles.npy'))
+grid = SphereGrid(2.0, hemisphere=True)
+hist = angleHistogram(angles, grid, chunkSize=chunkSize)
+fixedResolution(PSFModel(), hist, grid, 2.0, chunkPairs)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print((peak - base) / 1024.)
+"""
+
+
+class TestCryoEFMemory(BaseTest):
+    """ Check that conversion and the plugin PSF engine stay within the
+    memory budget for a set much larger than the budget. """
+    PARTICLES = 1000000
+    BUDGET = 64  # MB
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dbName = cls.getOutputPath('particles.sqlite')
+        cls.writeParticlesDb(cls.dbName, cls.PARTICLES)
+
+    @staticmethod
+    def writeParticlesDb(dbName, size, chunkSize=100000):
+        """ Write a minimal particles sqlite with random transformations. """
+        rng = np.random.default_rng(0)
+        conn = sqlite3.connect(dbName)
+        conn.execute('CREATE TABLE Classes (id INTEGER PRIMARY KEY, '
+                     'label_property TEXT, column_name TEXT, class_name TEXT)')
+        conn.executemany('INSERT INTO Classes (label_property, column_name, '
+                         'class_name) VALUES (?, ?, ?)',
+                         [('self', 'self', 'Particle'),
+                          ('_transform._matrix', 'c00', 'Matrix')])
+        conn.execute('CREATE TABLE Objects (id INTEGER PRIMARY KEY, '
+                     'enabled INTEGER, label TEXT, comment TEXT, '
+                     'creation TEXT, c00 TEXT)')
+        for start in range(0, size, chunkSize):
+            n = min(chunkSize, size - start)
+            rotations = np.linalg.qr(rng.normal(size=(n, 3, 3)))[0]
+            matrices = np.tile(np.eye(4), (n, 1, 1))
+            matrices[:, :3, :3] = rotations
+            conn.executemany('INSERT INTO Objects (id, enabled, c00) '
+                             'VALUES (?, 1, ?)',
+                             ((start + i + 1, str(m)) for i, m
+                              in enumerate(matrices.tolist())))
+        conn.commit()
+        conn.close()
+
+    def test_memoryBudget(self):
+        print(magentaStr("\n==> Testing cryoEF - memory budget:"))
+        prot = self.newProtocol(ProtCryoEF, memoryBudget=self.BUDGET)
+        args = [self.dbName, self.getOutputPath(),
+                prot._getChunkSize(), prot._getChunkSize(prot.BYTES_PER_PAIR)]
+        output = subprocess.check_output(
+            [sys.executable, '-c', MEMORY_SCRIPT] + [str(a) for a in args],
+            universal_newlines=True)
+        peak = float(output.split()[-1])
+        print("Peak memory above the baseline: %0.1f MB" % peak)
+        self.assertLess(peak, self.BUDGET)
+
+
+def randomMatrices(size, seed=0):
+    """ Random rotations as (size x 4 x 4) transformation matrices. """
+    rotations = np.linalg.qr(np.random.default_rng(seed).normal(
+        size=(size, 3, 3)))[0]
+    rotations[np.linalg.det(rotations) < 0, :, 0] *= -1
+    matrices = np.tile(np.eye(4), (size, 1, 1))
+    matrices[:, :3, :3] = rotations
+    return matrices
+
+
+class TestCryoEFConvert(BaseTest):
+    """ Angle conversion and serialization, without datasets. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def test_fromMatrices(self):
+        matrices = randomMatrices(500)
+        angles = AngleSet.from_matrices(matrices)
+        expected = np.array([geometryFromMatrix(m)[:2] for m in matrices])
+        diff = (np.column_stack([angles.rot, angles.tilt]) - expected +
+                180) % 360 - 180
+        self.assertLess(np.abs(diff).max(), 1e-3)
+
+    def test_serializers(self):
+        angles = AngleSet.from_matrices(randomMatrices(1000, seed=1))
+        textFn = self.getOutputPath('angles.dat')
+        angles.write(textFn)
+        angles[:10].write(textFn, append=True)
+        read = AngleSet.read(textFn)
+        self.assertEqual(len(read), 1010)
+        self.assertTrue(np.allclose(read.rot[:1000], angles.rot, atol=1e-5))
+        self.assertTrue(np.allclose(read.tilt[1000:], angles.tilt[:10],
+                                    atol=1e-5))
+        with open(textFn) as f:
+            self.assertEqual(len(f.readline().split()), 2)
+
+        binFn = self.getOutputPath('angles.npy')
+        angles.save(binFn)
+        for mmap in [False, True]:
+            loaded = AngleSet.load(binFn, mmap=mmap)
+            self.assertTrue(np.array_equal(loaded.rot, angles.rot))
+            self.assertTrue(np.array_equal(loaded.tilt, angles.tilt))
+
+
+class TestCryoEFProgress(BaseTest):
+    """ Progress parsing and time limit of the streamed cryoEF run, with a
+    Python script in place of the binary. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def test_parseProgress(self):
+        for line, fraction in [('45%', 0.45), ('  45.5 %\n', 0.455),
+                               ('Progress: 30%', 0.3),
+                               ('[#####     ] 50%', 0.5),
+                               ('100% done', 1.0),
+                               ('Processed 200/1000 particles', 0.2),
+                               ('200 of 1000 projections', 0.2)]:
+            self.assertAlmostEqual(parseProgress(line), fraction)
+        for line in ['Step 1/3', '(14 of 60 operators)', 'Step 1/3: 33%',
+                     'Using 50% of the memory', '/data/1/2',
+                     'Efficiency: 0.75']:
+            self.assertIsNone(parseProgress(line), line)
+
+    def test_progressNeverDecreases(self):
+        prot = self.newProtocol(ProtCryoEF)
+        seen = []
+        prot._updateProgress = lambda fraction, *args, **kwargs: \
+            seen.append(fraction)
+        script = ('for line in ["10%", "Step 1/3", "50%", "25%", '
+                  '"(14 of 60 operators)", "80%"]: print(line)')
+        prot._runStreamed([sys.executable, '-c', script], nParticles=100)
+        self.assertEqual(seen, [0., 0.1, 0.5, 0.8, 1.])
+
+    def test_timeLimit(self):
+        prot = self.newProtocol(ProtCryoEF)
+        prot._updateProgress = lambda *args, **kwargs: None
+        start = time.time()
+        with self.assertRaises(Exception):
+            prot._runStreamed([sys.executable, '-c',
+                               'import time; time.sleep(60)'], timeLimit=1)
+        self.assertLess(time.time() - start, 30)
+
+
+class TestCryoEFAdaptive(BaseTest):
+    """ Adaptive direction sampling against the fixed grid, on synthetic
+    preferred orientation sets (70% top views). """
+    PARTICLES = 200000
+    SAMPLING = 2.0
+    TOLERANCE = 0.1
+
+    def _topViews(self, spread, histGrid):
+        rng = np.random.default_rng(0)
+        top = int(0.7 * self.PARTICLES)
+        tilt = np.concatenate([
+            np.abs(rng.normal(0, spread, top)),
+            np.degrees(np.arccos(rng.uniform(-1, 1, self.PARTICLES - top)))])
+        angles = AngleSet(rng.uniform(-180, 180, self.PARTICLES), tilt)
+        return angleHistogram(angles, histGrid)
+
+    def test_adaptiveResolution(self):
+        histGrid = SphereGrid(self.SAMPLING, hemisphere=True)
+        model = PSFModel()
+        # spread of the top views (deg) and minimum reduction of the
+        # evaluations: the sharper the views, the more directions need
+        # to be evaluated around the edge of the missing cone
+        for spread, reduction in [(10, 10), (5, 5)]:
+            hist = self._topViews(spread, histGrid)
+            sums = []
+            grid, res, rows, weights = adaptiveResolution(
+                model, hist, histGrid, self.SAMPLING, self.TOLERANCE,
+                sums=sums)
+            fixedGrid, fixedRes = fixedResolution(model, hist, histGrid,
+                                                  self.SAMPLING)
+            evaluations = sum(len(block) for block in sums)
+            print("Top views spread %d deg: %d evaluations, fixed grid: %d"
+                  % (spread, evaluations, fixedGrid.size))
+            self.assertEqual(grid.size, fixedGrid.size)
+            self.assertLessEqual(np.abs(res - fixedRes).max(), self.TOLERANCE)
+            self.assertGreaterEqual(fixedGrid.size / evaluations, reduction)
+            # the stored sums give the same resolution again
+            again = sumsResolution(model, np.concatenate(sums), rows,
+                                   weights=weights)
+            self.assertLess(np.abs(again - res).max(), 1e-3)
+
+
+class TestCryoEFGroups(BaseTest):
+    """ Histograms grouped by micrograph, without datasets. """
+    def test_blockHistograms(self):
+        rng = np.random.default_rng(0)
+        grid = SphereGrid(10.0, hemisphere=True)
+        vectors = AngleSet.from_matrices(randomMatrices(20000)).to_vectors()
+        micIds = rng.integers(1, 200, len(vectors)) * 3
+        cells = grid.getIndex(vectors)
+        micHists = GroupHistograms(grid.size)
+        for start in range(0, len(vectors), 1500):
+            micHists.add(micIds[start:start + 1500], cells[start:start + 1500])
+
+        labels, counts = micHists.labels()
+        self.assertTrue(np.array_equal(labels, np.unique(micIds)))
+        self.assertEqual(counts.sum(), len(vectors))
+        _, hists = micHists.histograms()
+        self.assertTrue(np.array_equal(hists.sum(axis=1), counts))
+
+        # blocks of consecutive micrographs give the same sums as adding
+        # their particles
+        blocks = np.arange(len(labels)) * 4 // len(labels)
+        blockAccumulator = OrientationAccumulator(grid, grid.directions, 'c3')
+        accumulator = OrientationAccumulator(grid, grid.directions, 'c3')
+        for block, hist in enumerate(micHists.histograms(blocks)):
+            blockAccumulator.addHistogram(hist)
+            accumulator.add(vectors[np.isin(micIds, labels[blocks == block])])
+            self.assertEqual(blockAccumulator.count, accumulator.count)
+            self.assertTrue(np.allclose(blockAccumulator.sums,
+                                        accumulator.sums))
+
+
+class TestCryoEFDiameter(BaseTest):
+    """ Particle diameter estimation, without datasets. """
+    def test_estimateDiameter(self):
+        # noisy stack of discs of 40 px diameter, shifted by a few pixels
+        rng = np.random.default_rng(0)
+        size, samplingRate = 96, 2.5
+        y, x = np.mgrid[:size, :size] - size // 2
+        stack = []
+        for dy, dx in rng.integers(-2, 3, (64, 2)):
+            disc = ((y - dy) ** 2 + (x - dx) ** 2 <= 20 ** 2).astype(float)
+            stack.append(disc + rng.normal(0, 2, disc.shape))
+        average = np.mean(stack, axis=0)
+        diameter = estimateDiameter(average, samplingRate)
+        self.assertIsNotNone(diameter)
+        # the whole particle is inside, with the blur of the shifts
+        self.assertGreaterEqual(diameter, 40 * samplingRate)
+        self.assertLessEqual(diameter, 48 * samplingRate)
+        # no particle in pure noise
+        self.assertIsNone(estimateDiameter(np.zeros((size, size)),
+                                           samplingRate))
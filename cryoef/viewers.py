@@ -24,16 +24,28 @@
 # *
 # **************************************************************************
 import os
+import queue
+import threading
 
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
-from pyworkflow.protocol.params import LabelParam, EnumParam, IntParam
+from pyworkflow.protocol.params import (LabelParam, EnumParam, IntParam,
+                                        StringParam)
 from pyworkflow.viewer import DESKTOP_TKINTER
 from pwem.viewers import DataView, EmPlotter, EmProtocolViewer, ChimeraView
 
-from .protocols import ProtCryoEF
-from .convert import iterAngles
+from .protocols import ProtCryoEF, ProtCryoEFCompare
+from .convert import SphereGrid
 from .constants import VOLUME_SLICES, VOL_RS_PSF, VOLUME_CHIMERA
 
+# Sphere grid sampling (deg) of the Mollweide density and maximum number
+# of particles drawn
+MOLLWEIDE_SAMPLING = 3.0
+MOLLWEIDE_POINTS = 200000
+# Sphere grid sampling (deg) of the 2D angular distribution
+ANGDIST_SAMPLING = 3.0
+# Particles used for the first, quick version of the plots
+PREVIEW_POINTS = 20000
+
 
 class CryoEFViewer(EmProtocolViewer):
     """ Visualization of cryoEF results. """
@@ -65,6 +77,13 @@ class CryoEFViewer(EmProtocolViewer):
                             'information coverage of the orientation '
                             'distribution. Ideally, it should be spherically '
                             'symmetric.')
+        group.addParam('volBoxSize', IntParam, default=-1,
+                       label='Volume box size (px)',
+                       help='Box size of the displayed volume, covering the '
+                            'field of view of the particles. Default (-1) '
+                            'uses the box of the run. Volumes not written by '
+                            'the run, or at another box size, are generated '
+                            'when first displayed and kept for later.')
         form.addParam('displayAngDist', LabelParam,
                       label='Display angular distribution',
                       help='Display angular distribution as '
@@ -73,16 +92,49 @@ class CryoEFViewer(EmProtocolViewer):
                       label='Mollweide projection plot of orientation distribution',
                       help='The orientation distributions of the particles are '
                            'plotted on an equal-area Mollweide projection, with '
-                           'the color scale representing the local Gaussian kernel '
-                           'density (probability distribution function '
-                           '[PDF]) of the distribution at every sampled orientation.')
+                           'the color scale representing the local density '
+                           '(relative to a uniform distribution) binned on an '
+                           'equal-area sphere grid at every sampled orientation.')
         form.addParam('spheresScale', IntParam, default=100,
                       expertLevel=LEVEL_ADVANCED,
                       label='Spheres size')
         form.addParam('doShowHistogram', LabelParam,
                       label="Show PSF resolution histogram")
+        form.addParam('doShowResMap', LabelParam,
+                      label="Show directional PSF resolution map",
+                      help='Mollweide map of the PSF resolution along every '
+                           'viewing direction, computed by the plugin PSF '
+                           'engine.')
+        form.addParam('doShowCoverage', LabelParam,
+                      label='Show Fourier coverage completeness',
+                      help='Fraction of the directions of each resolution '
+                           'shell, up to Nyquist, whose Fourier space '
+                           'coverage reaches the coverage threshold of the '
+                           'run (relative to a uniform distribution).')
+        form.addParam('doExplorePSF', LabelParam,
+                      label='Explore PSF model parameters',
+                      help='PSF resolution map with sliders for the B-factor, '
+                           'particle diameter, angular accuracy and FSC '
+                           'resolution. The map and the efficiency are '
+                           're-evaluated from the geometric sums stored by '
+                           'the plugin PSF engine as the sliders move.')
         form.addParam('doShowLog', LabelParam,
                       label="Show output log")
+        form.addParam('doShowAcqCurve', LabelParam,
+                      label="Show efficiency over acquisition",
+                      help='Efficiency and mean PSF resolution as the '
+                           'micrographs are added in acquisition order.')
+        group = form.addGroup('Subsets')
+        group.addParam('subsetIds', StringParam, default='',
+                       label='Particle ids',
+                       help='Ids of the particles of the subset, as ranges '
+                            '(e.g. 1-5000, 7000-9000) or the path of a text '
+                            'file with one id per line.')
+        group.addParam('doShowSubset', LabelParam,
+                       label='Show subset efficiency',
+                       help='Efficiency and PSF resolution of the particles '
+                            'given above, computed with the orientation '
+                            'index of the run.')
 
     def _getVisualizeDict(self):
         self.protocol._initialize()  # Load filename templates
@@ -90,21 +142,48 @@ class CryoEFViewer(EmProtocolViewer):
                 'displayAngDist': self._showAngularDistribution,
                 'showMollweidePlot': self._showMollweide,
                 'doShowHistogram': self._showHistogram,
-                'doShowLog': self._showLogFile
+                'doShowResMap': self._showResolutionMap,
+                'doShowCoverage': self._showCoverageCurve,
+                'doExplorePSF': self._explorePSF,
+                'doShowLog': self._showLogFile,
+                'doShowAcqCurve': self._showAcquisitionCurve,
+                'doShowSubset': self._showSubsetEfficiency
                 }
 
 # =============================================================================
 # ShowVolumes
 # =============================================================================
     def _showVolumes(self, param=None):
+        kind, boxSize = self.doShowOutVol.get(), self.volBoxSize.get()
+        volume = self.protocol.getPsfVolume(kind, boxSize, generate=False)
+        if volume is None and self.getTkRoot() is not None:
+            # generate the missing volume without blocking the window
+            BackgroundTask(
+                self.getTkRoot(),
+                lambda: self.protocol.getPsfVolume(kind, boxSize),
+                done=lambda fn: [v.show() for v in self._getVolumeViews(fn)],
+                error=lambda e: self.showError(
+                    'The PSF volume could not be generated: %s' % e,
+                    'Missing volume')).start()
+            return [self.infoMessage('The PSF volume is being generated, it '
+                                     'will be shown when ready.',
+                                     title='PSF volume')]
+        try:
+            volume = volume or self.protocol.getPsfVolume(kind, boxSize)
+        except Exception as e:
+            return [self.errorMessage('The PSF volume could not be '
+                                      'generated: %s' % e,
+                                      title='Missing volume')]
+        return self._getVolumeViews(volume)
+
+    def _getVolumeViews(self, volume):
         if self.displayVol == VOLUME_CHIMERA:
-            return self._showVolumesChimera()
+            return self._showVolumesChimera(volume)
         elif self.displayVol == VOLUME_SLICES:
-            return self._showVolumeShowj()
+            return self._showVolumeShowj(volume)
 
-    def _showVolumesChimera(self):
+    def _showVolumesChimera(self, volume):
         """ Create a chimera script to visualize selected volumes. """
-        volume = self._getVolumeName()
         cmdFile = self.protocol._getExtraPath('chimera_volumes.cxc')
         with open(cmdFile, 'w+') as f:
             localVol = os.path.relpath(volume,
@@ -114,8 +193,8 @@ class CryoEFViewer(EmProtocolViewer):
         view = ChimeraView(cmdFile)
         return [view]
 
-    def _showVolumeShowj(self):
-        return [DataView(self._getVolumeName())]
+    def _showVolumeShowj(self, volume):
+        return [DataView(volume)]
 
 # =============================================================================
 # showAngularDistribution
@@ -128,94 +207,549 @@ class CryoEFViewer(EmProtocolViewer):
         return views
 
     def _createAngDist2D(self):
-        # Common variables to use
-        nparts = self.protocol._getInputParticles().getSize()
+        """ Polar plot of the particle counts binned on a sphere grid. A
+        subsample is drawn first and refined when all the angles have been
+        counted in the background. """
+        import numpy as np
+
         title = "Angular Distribution"
         plotter = EmPlotter(windowTitle=title)
-        sqliteFn = self.protocol._getFileName('projections')
-        if not os.path.exists(sqliteFn):
-            self.createAngDistributionSqlite(sqliteFn, nparts,
-                                             itemDataIterator=iterAngles(
-                                                 self.protocol._getFileName('anglesFn')))
-        plotter.plotAngularDistributionFromMd(sqliteFn, title)
+        ax = plotter.createSubPlot(title, '', '', projection='polar')
+        ax.set_ylim(0, 180)
+        grid = SphereGrid(ANGDIST_SAMPLING)
+        rot, tilt = grid.getAngles()
+        points = ax.scatter(np.empty(0), np.empty(0), c='blue', marker='.')
+
+        def draw(result):
+            counts, label = result
+            occupied = counts > 0
+            maxCount = max(counts.max(), 1)
+            points.set_offsets(np.column_stack([np.radians(rot[occupied]),
+                                                tilt[occupied]]))
+            points.set_sizes(counts[occupied] / maxCount * 35 + 5)
+            ax.set_xlabel('%s\nMin weight=0.00, Max weight=%0.2f'
+                          % (label, maxCount))
+
+        BackgroundPlot(plotter.getFigure(),
+                       lambda cancelled: self._iterCounts(grid, cancelled),
+                       draw).start()
 
         return plotter
 
+    def _iterCounts(self, grid, cancelled):
+        """ Yield the grid counts of a subsample of the particles and then
+        of all of them, counting chunk by chunk until cancelled. """
+        import numpy as np
+
+        angles = self.protocol.getAngles(mmap=True)
+        preview = angles[::max(1, len(angles) // PREVIEW_POINTS)]
+        if len(preview) < len(angles):
+            counts = grid.histogram(preview.to_vectors())
+            yield (counts * len(angles) / max(len(preview), 1),
+                   'Preview: %d of %d particles' % (len(preview), len(angles)))
+        counts = np.zeros(grid.size)
+        for chunk in angles.iterChunks(self.protocol._getChunkSize()):
+            if cancelled.is_set():
+                return
+            counts += grid.histogram(chunk.to_vectors())
+        yield counts, '%d particles' % len(angles)
+
     def _showMollweide(self, param=None):
         """ This plot script is based on two scripts by their respective authors:
             - PlotOD.py from cryoEF package
             - https://github.com/PirateFernandez/python3_rln_scripts/blob/main/rln_star_2_mollweide_any_star.py
+
+        The angles are read memory-mapped: the density is binned on a sphere
+        grid chunk by chunk and at most MOLLWEIDE_POINTS particles are drawn.
+        A subsample is drawn first while the rest is binned in the background.
         """
         import numpy as np
-        from matplotlib import spines
-        from scipy.stats import gaussian_kde
 
-        views = []
         xplotter = EmPlotter(windowTitle="Mollweide projection plot of orientation distribution")
-        fn = np.genfromtxt(self.protocol._getFileName('anglesFn'), delimiter=' ')
-        phi = fn[:, 0]
-        theta = fn[:, 1]
-
-        # Convert degrees to radians and obey angular range conventions
-        x = phi / 180 * np.pi  # x is the phi angle (longitude)
-        y = theta / 180 * np.pi  # y is the theta angle (latitude)
-        y = -1 * y + np.pi / 2  # The convention in RELION is [0, 180] for theta,
-        # whereas for the projection function it is [90, -90], so this conversion is required.
-        vertical_rad = np.vstack([y, x])
-        m = gaussian_kde(vertical_rad)(vertical_rad)
-
         ax = xplotter.createSubPlot('', 'phi', 'theta',
                                     projection="mollweide")
-        # Plot your points on the projection
-        # ax.plot(x, y, ',', alpha=0.5, color='#64B5F6')  # alpha - transparency (from 0 to 1), color - specify hex code
-        a = ax.scatter(x, y, cmap='plasma', c=m, s=2, alpha=0.4)
-        # Draw the horizontal and the vertical grid lines. Can add more grid lines if required.
-        major_ticks_x = [-np.pi, -np.pi / 2, 0, np.pi / 2, np.pi]
-        major_ticks_y = [-np.pi / 2, -np.pi / 4, 0, np.pi / 4, np.pi / 2]
-        ax.set_xticks(major_ticks_x)
-        ax.set_yticks(major_ticks_y)
-        ax.set_xticklabels([r'-180$^\circ$', r'-90$^\circ$', r'0$^\circ$', r'90$^\circ$', r'180$^\circ$'],
-                           color='grey')
-        ax.set_yticklabels([r'-90$^\circ$', r'-45$^\circ$', r'0$^\circ$', r'45$^\circ$', r'90$^\circ$'],
-                           color='grey')
-
-        # Set the color and the thickness of the grid lines
-        ax.grid(which='both', linestyle='--', linewidth=1, color='#555F61')
-
-        # Set the color and the thickness of the outlines
-        for child in ax.get_children():
-            if isinstance(child, spines.Spine):
-                child.set_color('#555F61')
-
-        xplotter.getColorBar(a)
-        xplotter.tightLayout()
-        xplotter.show()
-
-        return views.append(xplotter)
+        # Plot your points on the projection, they are filled in as the
+        # background computation goes
+        a = ax.scatter(np.empty(0), np.empty(0), c=np.empty(0),
+                       cmap='plasma', s=2, alpha=0.4)
+        setupMollweideAxes(ax)
+        colorBar = []
+
+        def draw(result):
+            x, y, m, label = result
+            a.set_offsets(np.column_stack([x, y]))
+            a.set_array(m)
+            a.set_clim(m.min(), max(m.max(), m.min() + 1e-6))
+            ax.set_title(label)
+            if colorBar:
+                updateColorBarTicks(colorBar[0], a)
+            else:
+                xplotter.getColorBar(a)
+                colorBar.append(a.colorbar)
+
+        BackgroundPlot(xplotter.getFigure(), self._iterMollweide, draw).start()
+
+        return [xplotter]
+
+    def _iterMollweide(self, cancelled):
+        """ Yield the Mollweide points and densities of a subsample of the
+        particles and then of the whole set. """
+        import numpy as np
+
+        angles = self.protocol.getAngles(mmap=True)
+        grid = SphereGrid(MOLLWEIDE_SAMPLING)
+        preview = angles[::max(1, len(angles) // PREVIEW_POINTS)]
+        if len(preview) < len(angles):
+            hist = grid.histogram(preview.to_vectors())
+            yield mollweidePoints(grid, hist, preview) + (
+                'Preview: %d of %d particles' % (len(preview), len(angles)),)
+        hist = np.zeros(grid.size)
+        for chunk in angles.iterChunks(self.protocol._getChunkSize()):
+            if cancelled.is_set():
+                return
+            hist += grid.histogram(chunk.to_vectors())
+        angles = angles[::max(1, len(angles) // MOLLWEIDE_POINTS)]
+        yield mollweidePoints(grid, hist, angles) + ('',)
 
     def _showHistogram(self, param=None):
+        import numpy as np
+
         fn = self.protocol._getFileName('output_hist')
-        with open(fn) as f:
-            views = []
-            numberOfBins = 10
-            plotter = EmPlotter()
-            plotter.createSubPlot("PSF Resolution histogram",
-                                  "Resolution (A)", "Ang (str)")
-            resolution = [float(line.strip()) for line in f]
-        plotter.plotHist(resolution, nbins=numberOfBins)
-        plotter.show()
-
-        return views.append(plotter)
+        numberOfBins = 10
+        plotter = EmPlotter()
+        plotter.createSubPlot("PSF Resolution histogram",
+                              "Resolution (A)", "Ang (str)")
+
+        def load(cancelled):
+            yield np.loadtxt(fn, ndmin=1)
+
+        BackgroundPlot(plotter.getFigure(), load,
+                       lambda resolution: plotter.plotHist(
+                           resolution, nbins=numberOfBins)).start()
+
+        return [plotter]
+
+    def _showResolutionMap(self, param=None):
+        if not os.path.exists(self.protocol._getFileName('res_map')):
+            return [self.errorMessage('The resolution map is computed by the '
+                                      'plugin PSF engine only.',
+                                      title='Missing resolution map')]
+        resMap = self.protocol.getResolutionMap()
+        # the whole sphere, antipodal directions have the same resolution
+        grid = SphereGrid(resMap.grid.angSampling)
+        plotter = EmPlotter(windowTitle='Directional PSF resolution')
+        plotSphereMap(plotter, grid, resMap.lookupVectors(grid.directions),
+                      title='PSF resolution (A)', cmap='viridis_r')
+
+        return [plotter]
+
+    def _showCoverageCurve(self, param=None):
+        import numpy as np
+
+        curveFn = self.protocol._getFileName('coverage_curve')
+        if not os.path.exists(curveFn):
+            return [self.errorMessage('The coverage curve is computed by the '
+                                      'plugin PSF engine only.',
+                                      title='Missing curve')]
+        curve = np.load(curveFn)
+        freqs = curve['freqs']
+        plotter = EmPlotter(windowTitle='Fourier coverage completeness')
+        ax = plotter.createSubPlot('Fourier coverage completeness',
+                                   'Resolution (A)', 'Fraction')
+        ax.plot(freqs, curve['completeness'], '-', color='#1976D2',
+                label='relative coverage >= %0.2f' % curve['threshold'])
+        ax.set_ylim(0, 1.05)
+        ax.set_xlim(0, freqs[-1])
+        ticks = ax.get_xticks()
+        ticks = ticks[(ticks > 0) & (ticks <= freqs[-1])]
+        ax.set_xticks(ticks)
+        ax.set_xticklabels(['%0.1f' % (1 / t) for t in ticks])
+        ax.legend(loc='lower left')
+        plotter.tightLayout()
+
+        return [plotter]
+
+    def _explorePSF(self, param=None):
+        from matplotlib.widgets import Slider
+        from .analysis import PSFModel
+
+        prot = self.protocol
+        if not os.path.exists(prot._getFileName('psf_sums')):
+            return [self.errorMessage('The geometric sums are stored by the '
+                                      'plugin PSF engine only.',
+                                      title='Missing geometric sums')]
+        grid, res = prot.evaluatePSF()
+        plotter = EmPlotter(windowTitle='PSF model parameters')
+        fig = plotter.getFigure()
+        fig.subplots_adjust(bottom=0.35)
+        ax = plotSphereMap(plotter, grid, res)
+        points = ax.collections[0]
+
+        def setTitle(res):
+            eff, meanRes = PSFModel.statistics(res)[:2]
+            ax.set_title('Efficiency %0.2f, mean PSF resolution %0.2f A'
+                         % (eff, meanRes))
+
+        # key, label, range and current value of each parameter
+        specs = [('bfactor', 'B-factor (A^2)', 10, 500, prot.Bfact.get()),
+                 ('diameter', 'Diameter (A)', 10, 1000, prot.diam.get()),
+                 ('angAcc', 'Ang. accuracy (deg)', 0, 10, prot.angAcc.get()),
+                 ('fscRes', 'FSC res. (A), 0: auto', 0, 20,
+                  max(prot.FSCres.get(), 0))]
+        sliders = {}
+        for i, (key, label, vmin, vmax, value) in enumerate(specs):
+            sliderAx = fig.add_axes([0.25, 0.05 + 0.06 * i, 0.5, 0.03])
+            sliders[key] = Slider(sliderAx, label, vmin,
+                                  max(vmax, 2 * value), valinit=value)
+
+        def update(value):
+            kwargs = {key: slider.val for key, slider in sliders.items()}
+            res = prot.evaluatePSF(**kwargs)[1]
+            points.set_array(res)
+            points.set_clim(res.min(), max(res.max(), res.min() + 1e-6))
+            updateColorBarTicks(points.colorbar, points)
+            setTitle(res)
+            fig.canvas.draw_idle()
+
+        for slider in sliders.values():
+            slider.on_changed(update)
+        setTitle(res)
+        plotter.sliders = sliders  # widgets only respond while referenced
+
+        return [plotter]
 
     def _showLogFile(self, param=None):
         view = self.textView([self.protocol._getFileName('output_log')],
                              "Output log file")
         return [view]
 
-    def _getVolumeName(self):
-        if self.doShowOutVol.get() == VOL_RS_PSF:
-            vol = self.protocol._getFileName('real space PSF')
-        else:  # VOL_FS_PSF
-            vol = self.protocol._getFileName('fourier space PSF')
+    def _showAcquisitionCurve(self, param=None):
+        import numpy as np
+
+        curveFn = self.protocol._getFileName('acq_curve')
+        if not os.path.exists(curveFn):
+            return [self.errorMessage('The efficiency over acquisition was '
+                                      'not computed by this run.',
+                                      title='Missing curve')]
+        curve = np.load(curveFn)
+        plotter = EmPlotter(windowTitle='Efficiency over acquisition')
+        ax = plotter.createSubPlot('Efficiency over acquisition',
+                                   'Micrographs', 'Efficiency')
+        ax.plot(curve['micrographs'], curve['efficiency'], 'o-',
+                color='#1976D2', label='efficiency')
+        ax.set_ylim(0, 1.05)
+        ax2 = ax.twinx()
+        ax2.plot(curve['micrographs'], curve['meanRes'], 's--',
+                 color='#E64A19', label='mean PSF resolution')
+        ax2.set_ylabel('Mean PSF resolution (A)')
+        # particle counts on the top axis
+        top = ax.twiny()
+        top.set_xlim(ax.get_xlim())
+        ticks = ax.get_xticks()
+        ticks = ticks[(ticks >= 0) & (ticks <= curve['micrographs'][-1])]
+        top.set_xticks(ticks)
+        top.set_xticklabels(['%d' % p for p in np.interp(
+            ticks, np.append(0, curve['micrographs']),
+            np.append(0, curve['particles']))])
+        top.set_xlabel('Particles')
+        plotter.tightLayout()
+
+        return [plotter]
+
+    def _showSubsetEfficiency(self, param=None):
+        import numpy as np
+        from pyworkflow.utils import getListFromRangeString
+
+        prot = self.protocol
+        if not os.path.exists(prot._getFileName('index_ids')):
+            return [self.errorMessage('The orientation index was not '
+                                      'computed by this run.',
+                                      title='Missing index')]
+        subset = self.subsetIds.get('').strip()
+        try:
+            if os.path.isfile(subset):
+                ids = np.loadtxt(subset, dtype=np.int64, ndmin=1)
+            else:
+                ids = getListFromRangeString(subset)
+        except ValueError:
+            return [self.errorMessage('Could not read the particle ids: %s'
+                                      % subset, title='Invalid subset')]
+        count, stats = prot.subsetEfficiency(ids)
+        if not count:
+            return [self.errorMessage('None of the given ids is in the input '
+                                      'particles.', title='Empty subset')]
+        msg = ('Particles: %d of %d\n'
+               'Efficiency: %0.2f\n'
+               'Mean PSF resolution: %0.2f A\n'
+               'Standard deviation: %0.2f A\n'
+               'Worst PSF resolution: %0.2f A\n'
+               'Best PSF resolution: %0.2f A'
+               % ((count, len(prot.getOrientationIndex())) + tuple(stats)))
+
+        return [self.infoMessage(msg, title='Subset efficiency')]
+
+
+class CryoEFCompareViewer(EmProtocolViewer):
+    """ Visualization of orientation distribution comparisons. """
+
+    _environments = [DESKTOP_TKINTER]
+    _targets = [ProtCryoEFCompare]
+    _label = 'viewer'
+
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+        form.addParam('doShowMetrics', LabelParam,
+                      label='Show distances to the reference',
+                      help='Plot the Jensen-Shannon divergence, the earth '
+                           'mover\'s distance and the efficiency difference '
+                           'of every set with respect to the reference.')
+        form.addParam('displaySet', IntParam, default=2,
+                      label='Set to compare',
+                      help='Number of the input set (starting at 1) compared '
+                           'with the reference in the plots below.')
+        form.addParam('doShowDensityDiff', LabelParam,
+                      label='Show density difference map',
+                      help='Mollweide plot of the orientation density of the '
+                           'selected set minus the reference one, relative '
+                           'to a uniform distribution.')
+        form.addParam('doShowCoverageGap', LabelParam,
+                      label='Show coverage gap map',
+                      help='Cells covered only by the reference (-1, lost) '
+                           'or only by the selected set (+1, gained).')
+        form.addParam('doShowDiffVolume', LabelParam,
+                      label='Show fourier space PSF difference',
+                      help='Difference of the normalized k-space PSF of the '
+                           'selected set and the reference.')
+
+    def _getVisualizeDict(self):
+        self.protocol._initialize()  # Load filename templates
+        return {'doShowMetrics': self._showMetrics,
+                'doShowDensityDiff': self._showDensityDiff,
+                'doShowCoverageGap': self._showCoverageGap,
+                'doShowDiffVolume': self._showDiffVolume
+                }
+
+    def _loadResults(self):
+        import numpy as np
+        return np.load(self.protocol._getFileName('comparison'))
+
+    def _getSetIndex(self):
+        index = self.displaySet.get() - 1
+        if not 0 < index < len(self.protocol.inputSets):
+            index = 1
+        return index
+
+    def _showMetrics(self, param=None):
+        import numpy as np
+
+        results = self._loadResults()
+        labels = [str(i + 1) for i in range(1, len(self.protocol.inputSets))]
+        x = np.arange(len(labels))
+        plotter = EmPlotter(x=1, y=3, windowTitle='Distances to the reference')
+        for values, title in [(results['jensenShannon'], 'JS divergence'),
+                              (results['emd'], 'EMD (deg)'),
+                              (results['efficiencyDelta'], 'Efficiency delta')]:
+            ax = plotter.createSubPlot(title, 'Set', '')
+            ax.bar(x, values, color='#64B5F6')
+            ax.set_xticks(x)
+            ax.set_xticklabels(labels)
+        plotter.tightLayout()
+
+        return [plotter]
+
+    def _showDensityDiff(self, param=None):
+        results = self._loadResults()
+        hists = results['histograms']
+        index = self._getSetIndex()
+        grid = SphereGrid(float(results['angSampling']))
+        density = hists / hists.sum(axis=1, keepdims=True) * grid.size
+        diff = density[index] - density[0]
+        vmax = max(abs(diff).max(), 1e-6)
+        plotter = EmPlotter(windowTitle='Density difference')
+        plotSphereMap(plotter, grid, diff, cmap='RdBu_r', vmin=-vmax, vmax=vmax,
+                      title='Set %d - reference' % (index + 1))
+
+        return [plotter]
+
+    def _showCoverageGap(self, param=None):
+        results = self._loadResults()
+        index = self._getSetIndex()
+        grid = SphereGrid(float(results['angSampling']))
+        plotter = EmPlotter(windowTitle='Coverage gap map')
+        plotSphereMap(plotter, grid, results['coverageGap'][index - 1],
+                      cmap='RdBu', vmin=-1, vmax=1,
+                      title='Set %d: lost (-1) / gained (+1)' % (index + 1))
+
+        return [plotter]
+
+    def _showDiffVolume(self, param=None):
+        volFn = self.protocol._getFileName('difference PSF',
+                                           set=self._getSetIndex())
+        if not os.path.exists(volFn):
+            return [self.errorMessage('Difference volume not available for '
+                                      'this set.', title='Missing volume')]
+
+        return [DataView(volFn)]
+
+
+class BackgroundPlot:
+    """ Compute the data of a plot in a worker thread and draw it as it
+    arrives, so the viewer window is shown and stays responsive.
+
+    compute(cancelled) is a generator run in the worker: it may yield a
+    quick preview first and then refined data, and should return when the
+    cancelled event is set. draw(result) is called on the GUI thread,
+    from a timer polling the results queue, for each yielded result. The
+    computation is cancelled when the figure is closed.
+    """
+    POLL_INTERVAL = 100  # ms
+
+    def __init__(self, figure, compute, draw):
+        self._figure = figure
+        self._draw = draw
+        self._results = queue.Queue()
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._worker = threading.Thread(target=self._run, args=(compute,),
+                                        daemon=True)
+        self._timer = figure.canvas.new_timer(interval=self.POLL_INTERVAL)
+        self._timer.add_callback(self._poll)
+        figure.canvas.mpl_connect('close_event', self._onClose)
+
+    def start(self):
+        self._worker.start()
+        self._timer.start()
+        return self
+
+    def _run(self, compute):
+        try:
+            for result in compute(self._cancelled):
+                if self._cancelled.is_set():
+                    break
+                self._results.put(result)
+        except Exception as e:
+            self._results.put(e)
+        finally:
+            self._done.set()
+
+    def _poll(self):
+        done = self._done.is_set()  # before draining: no result is missed
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(result, Exception):
+                self._figure.suptitle('Error: %s' % result, color='red')
+            else:
+                self._draw(result)
+            self._figure.canvas.draw_idle()
+        if done:
+            self._timer.stop()
+
+    def _onClose(self, event):
+        self._cancelled.set()
+        self._timer.stop()
+
+
+class BackgroundTask:
+    """ Run a function in a worker thread and call done(result), or
+    error(exception), on the GUI thread when it finishes. The worker is
+    polled from a Tk timer, so the viewer window stays responsive.
+    """
+    POLL_INTERVAL = 100  # ms
+
+    def __init__(self, root, function, done, error):
+        self._root = root
+        self._onDone = done
+        self._onError = error
+        self._result = None
+        self._finished = threading.Event()
+        self._worker = threading.Thread(target=self._run, args=(function,),
+                                        daemon=True)
+
+    def start(self):
+        self._worker.start()
+        self._root.after(self.POLL_INTERVAL, self._poll)
+        return self
+
+    def _run(self, function):
+        try:
+            self._result = function()
+        except Exception as e:
+            self._result = e
+        finally:
+            self._finished.set()
+
+    def _poll(self):
+        if not self._finished.is_set():
+            self._root.after(self.POLL_INTERVAL, self._poll)
+        elif isinstance(self._result, Exception):
+            self._onError(self._result)
+        else:
+            self._onDone(self._result)
+
+
+def mollweidePoints(grid, hist, angles):
+    """ Return the Mollweide coordinates of the angles and the density
+    (relative to a uniform distribution) of the grid cell of each one. """
+    import numpy as np
+
+    density = hist / max(hist.sum(), 1) * grid.size
+    # Convert degrees to radians and obey angular range conventions
+    x = np.radians(angles.rot.astype(np.float64))  # x is the phi angle (longitude)
+    y = np.radians(angles.tilt.astype(np.float64))  # y is the theta angle (latitude)
+    y = -1 * y + np.pi / 2  # The convention in RELION is [0, 180] for theta,
+    # whereas for the projection function it is [90, -90], so this conversion is required.
+
+    return x, y, density[grid.getIndex(angles.to_vectors())]
+
+
+def updateColorBarTicks(colorBar, mappable):
+    """ Recompute the ticks of a color bar after the limits of its
+    mappable have changed. """
+    from matplotlib.ticker import MaxNLocator
+
+    vmin, vmax = mappable.get_clim()
+    ticks = MaxNLocator().tick_values(vmin, vmax)
+    colorBar.set_ticks(ticks[(ticks >= vmin) & (ticks <= vmax)])
+
+
+def setupMollweideAxes(ax):
+    """ Draw grid lines, ticks and outlines of a Mollweide projection axes. """
+    import numpy as np
+    from matplotlib import spines
+
+    # Draw the horizontal and the vertical grid lines. Can add more grid lines if required.
+    major_ticks_x = [-np.pi, -np.pi / 2, 0, np.pi / 2, np.pi]
+    major_ticks_y = [-np.pi / 2, -np.pi / 4, 0, np.pi / 4, np.pi / 2]
+    ax.set_xticks(major_ticks_x)
+    ax.set_yticks(major_ticks_y)
+    ax.set_xticklabels([r'-180$^\circ$', r'-90$^\circ$', r'0$^\circ$', r'90$^\circ$', r'180$^\circ$'],
+                       color='grey')
+    ax.set_yticklabels([r'-90$^\circ$', r'-45$^\circ$', r'0$^\circ$', r'45$^\circ$', r'90$^\circ$'],
+                       color='grey')
+
+    # Set the color and the thickness of the grid lines
+    ax.grid(which='both', linestyle='--', linewidth=1, color='#555F61')
+
+    # Set the color and the thickness of the outlines
+    for child in ax.get_children():
+        if isinstance(child, spines.Spine):
+            child.set_color('#555F61')
+
+
+def plotSphereMap(plotter, grid, values, title='', cmap='plasma', **kwargs):
+    """ Plot per-cell values of a SphereGrid as a Mollweide heat map. """
+    import numpy as np
+
+    rot, tilt = grid.getAngles()
+    x = np.radians(rot)
+    y = np.pi / 2 - np.radians(tilt)
+    ax = plotter.createSubPlot(title, 'phi', 'theta', projection="mollweide")
+    size = max(2, 4 * grid.angSampling)
+    a = ax.scatter(x, y, c=values, cmap=cmap, s=size, marker='s', **kwargs)
+    setupMollweideAxes(ax)
+    plotter.getColorBar(a)
 
-        return vol
+    return ax
@@ -24,15 +24,32 @@
 # *
 # **************************************************************************
 
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.gui.tree import ListTreeProvider
 from pwem.constants import UNIT_ANGSTROM
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Particle
 from pwem.wizards import ParticleMaskRadiusWizard
 
 from .protocols import ProtCryoEF
+from .analysis import estimateDiameter
 
 
 class cryoEFMaskDiameterWizard(ParticleMaskRadiusWizard):
     _targets = [(ProtCryoEF, ['diam'])]
     _unit = UNIT_ANGSTROM
+    # Number of particles read to build the preview
+    _sampleSize = 64
+    # Previews kept in memory, keyed by (set file, modification time),
+    # so the wizard opens instantly the next time for the same input
+    _maxCached = 8
+    _previewCache = OrderedDict()
 
     def _getParameters(self, protocol):
         label, value = self._getInputProtocol(self._targets, protocol)
@@ -44,13 +61,21 @@ class cryoEFMaskDiameterWizard(ParticleMaskRadiusWizard):
         return protParams
 
     def _getProvider(self, protocol):
-        _objs = self._getParameters(protocol)['input']
-        return ParticleMaskRadiusWizard._getListProvider(self, _objs)
+        preview = self._getPreview(protocol)
+        if preview is None:
+            return None
+        return ListTreeProvider(preview['particles'])
 
     def show(self, form, *args):
         params = self._getParameters(form.protocol)
         _value = params['value']
         _label = params['label']
+        preview = self._getPreview(form.protocol)
+        paramDefault = form.protocol.getParam(_label).default.get()
+        if (preview is not None and preview['diameter'] and
+                _value * 2 == float(paramDefault)):
+            # Start from the diameter estimated on the average
+            _value = preview['diameter'] / 2
         ParticleMaskRadiusWizard.show(self, form, _value, _label, units=self._unit)
 
     def setVar(self, form, label, value):
@@ -59,3 +84,80 @@ class cryoEFMaskDiameterWizard(ParticleMaskRadiusWizard):
 
     def _getProtocolImages(self, protocol):
         return protocol.inputParticles
+
+    def _getPreview(self, protocol):
+        """ Return the cached preview of the input particles, creating it
+        if the set is new or was modified. """
+        partSet = self._getProtocolImages(protocol).get()
+        if partSet is None:
+            return None
+
+        fn = partSet.getFileName()
+        key = (fn, os.path.getmtime(fn))
+        cache = self._previewCache
+        if key not in cache:
+            cache[key] = self._createPreview(protocol, partSet)
+            while len(cache) > self._maxCached:
+                cache.popitem(last=False)
+        cache.move_to_end(key)
+
+        return cache[key]
+
+    def _createPreview(self, protocol, partSet):
+        """ Read a stratified sample of the particles (one every n ids
+        over the id range of the set, without listing the whole set) and
+        compute their average. """
+        ids = [p.getObjId() for direction in ['ASC', 'DESC'] for p in
+               partSet.iterItems(direction=direction, limit=1)]
+        if not ids:
+            return None
+        firstId, lastId = ids
+        step = max(1, (lastId - firstId + 1) // self._sampleSize)
+        while True:
+            where = '(id - %d) %% %d = 0' % (firstId, step)
+            particles = [p.clone() for p in
+                         partSet.iterItems(where=where,
+                                           limit=self._sampleSize)]
+            # gaps in the ids leave fewer particles, sample more densely
+            if len(particles) >= self._sampleSize or step == 1:
+                break
+            step = max(1, step * len(particles) // self._sampleSize)
+
+        ih = ImageHandler()
+        average = np.zeros(particles[0].getDim()[1::-1], dtype=np.float64)
+        for part in particles:
+            average += ih.read(part).getData()
+        average /= len(particles)
+
+        samplingRate = partSet.getSamplingRate()
+        avgFn = self._getAverageFn(protocol, partSet)
+        self._writeAverage(average, samplingRate, avgFn)
+        avg = Particle(location=avgFn)
+        avg.setSamplingRate(samplingRate)
+        avg.setObjId(0)
+        avg.setObjLabel('average')
+
+        return {'particles': [avg] + particles,
+                'diameter': estimateDiameter(average, samplingRate)}
+
+    @staticmethod
+    def _getAverageFn(protocol, partSet):
+        """ File of the average of a set in the protocol tmp folder, or in
+        the project one if the protocol was not saved yet. The name only
+        depends on the set file, so it is overwritten and not leaked. """
+        name = 'cryoef_average_%s.mrc' % hashlib.md5(
+            partSet.getFileName().encode()).hexdigest()[:12]
+        if protocol.workingDir.hasValue():
+            fn = protocol._getTmpPath(name)
+        else:
+            fn = protocol.getProject().getTmpPath(name)
+        pwutils.makePath(os.path.dirname(fn))
+        return fn
+
+    @staticmethod
+    def _writeAverage(average, samplingRate, fn):
+        import mrcfile
+
+        with mrcfile.new(fn, overwrite=True) as mrc:
+            mrc.set_data(average.astype(np.float32))
+            mrc.voxel_size = samplingRate